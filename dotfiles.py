@@ -2,11 +2,20 @@
 import os
 import stat
 import sys
+import json
+import time
+import errno
 import shutil
+import tarfile
+import tempfile
+import threading
 from fnmatch import fnmatch
+from glob import glob
 import subprocess
 from subprocess import call, STDOUT
 from optparse import OptionParser
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 try:
     # Python 2
@@ -14,6 +23,30 @@ try:
 except ImportError:
     # Python 3
     from urllib.request import urlretrieve
+try:
+    # Python >= 3.3
+    from time import perf_counter as timer
+except ImportError:
+    from time import time as timer
+try:
+    # Python >= 3.3
+    from subprocess import TimeoutExpired
+except ImportError:
+    TimeoutExpired = None  # no timeouts for subprocesses
+try:
+    # Python 3
+    from queue import Queue
+except ImportError:
+    # Python 2
+    from Queue import Queue
+try:
+    # Python >= 3.11
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 try:
     # make 'input' available in Python 2
     input = raw_input
@@ -45,82 +78,1125 @@ except ImportError:
 
 HOME = os.environ["HOME"]
 DOTFILES = os.path.split(os.path.realpath(__file__))[0]
+CONFLICT_POLICIES = ("backup", "skip", "overwrite", "fail")
+# Journaled operations whose key is a path (see `Deployment._journal_key`)
+JOURNAL_PATH_OPERATIONS = ("link", "clone", "get", "deploy_repo")
+
+# Commands for measuring the startup time of interactive tools, see
+# `Deployment.bench`. The placeholder {home} is replaced with the home folder,
+# and {startuptime} with a file into which the tool writes its own timing
+BENCH_COMMANDS = {
+    "bash": ["bash", "-i", "-c", "exit"],
+    "tmux": [
+        "tmux",
+        "-L",
+        "dotfiles_bench",
+        "-f",
+        "{home}/.tmux.conf",
+        "start-server",
+        ";",
+        "kill-server",
+    ],
+    "vim": [
+        "vim",
+        "-N",
+        "--not-a-term",
+        "--startuptime",
+        "{startuptime}",
+        "+qa",
+    ],
+    "nvim": ["nvim", "--headless", "--startuptime", "{startuptime}", "+qa"],
+}
+BENCH_THRESHOLD = 0.05  # seconds by which the median may exceed the baseline
+BENCH_TIMEOUT = 60  # seconds after which a benchmarked command is killed
 
 
 def is_file_or_link(file):
     return os.path.isfile(file) or os.path.islink(file)
 
 
-def make_link(src, dst, options):
-    """Create a symbolic link pointing to src named dst.
+class Journal(object):
+    """Append-only journal of the operations performed by a deployment.
+
+    Every line in the journal file is a tab-separated record. A deployment
+    starts with a 'start' record (containing the `mode`, 'install' or
+    'uninstall') and, if it finishes without error, ends with an 'end' record.
+    In between, 'begin' and 'done' records mark the start and completion of
+    individual operations, each identified by the name of the operation and a
+    key (e.g. the absolute path of a link).
+
+    When the journal is instantiated, it reads the records of the previous
+    deployment. If that deployment was interrupted (no 'end' record) and ran
+    in the same `mode`, the new deployment is a resumed deployment: any
+    operation completed previously is reported as done by `is_done`, so that
+    it can be skipped. Operations that were begun but not completed can be
+    rolled back with `recover`. A resumed deployment appends its records to
+    those of the interrupted deployment, so operations completed in any of
+    a series of interrupted deployments are remembered.
+    """
+
+    def __init__(self, filename, mode="install"):
+        self.filename = filename
+        self.mode = mode
+        self.resumed = False
+        self.completed = set()
+        self.interrupted = []
+        self._lock = threading.Lock()
+        self._fh = None
+        if os.path.isfile(filename):
+            self._read()
+
+    def _read(self):
+        """Read the records of the previous deployment"""
+        run_mode = None
+        ended = False
+        begun = []
+        done = set()
+        with open(self.filename) as in_fh:
+            for line in in_fh:
+                fields = line.rstrip("\n").split("\t")
+                if fields[0] == "start" and len(fields) == 2:
+                    if ended or fields[1] != run_mode:
+                        done = set()
+                    # else: resumed run, keeps the completed operations
+                    run_mode = fields[1]
+                    ended = False
+                    begun = []
+                elif fields[0] == "begin" and len(fields) == 3:
+                    begun.append((fields[1], fields[2]))
+                elif fields[0] == "done" and len(fields) == 3:
+                    done.add((fields[1], fields[2]))
+                elif fields[0] == "end" and len(fields) == 1:
+                    ended = True
+                # anything else is a truncated record from a crash
+        if not ended:
+            self.interrupted = [op for op in begun if op not in done]
+            if run_mode == self.mode:
+                self.resumed = True
+                self.completed = done
+
+    def recover(self, quiet=False):
+        """Roll back all operations that were begun but not completed in the
+        previous deployment, if it was interrupted: remove partial clones and
+        partial downloads"""
+        for (operation, key) in self.interrupted:
+            if operation == "clone":
+                if os.path.isdir(key):
+                    if not quiet:
+                        print("removing partial clone %s" % key)
+                    shutil.rmtree(key)
+            elif operation == "get":
+                partial = key + ".part"
+                if is_file_or_link(partial):
+                    if not quiet:
+                        print("removing partial download %s" % partial)
+                    os.unlink(partial)
+        self.interrupted = []
+
+    def open(self):
+        """Start recording a new deployment. If resuming an interrupted
+        deployment, its records are kept, otherwise they are discarded"""
+        if self.resumed:
+            with open(self.filename, "rb") as in_fh:
+                in_fh.seek(0, os.SEEK_END)
+                truncated = False
+                if in_fh.tell() > 0:
+                    in_fh.seek(-1, os.SEEK_END)
+                    truncated = in_fh.read(1) != b"\n"
+            self._fh = open(self.filename, "a")
+            if truncated:  # terminate the record cut off by a crash
+                self._fh.write("\n")
+        else:
+            self._fh = open(self.filename, "w")
+        self._write("start", self.mode)
+
+    def _write(self, *fields):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.write("\t".join(fields) + "\n")
+                self._fh.flush()
+
+    def begin(self, operation, key):
+        """Record that `operation` for the given `key` has started"""
+        self._write("begin", operation, key)
+
+    def done(self, operation, key):
+        """Record that `operation` for the given `key` has completed"""
+        self._write("done", operation, key)
+
+    def is_done(self, operation, key):
+        """Check whether `operation` for the given `key` was completed in the
+        interrupted deployment that is being resumed"""
+        return (operation, key) in self.completed
+
+    def close(self, completed=False):
+        """Stop recording. If `completed` is True, mark the deployment as
+        finished, so that the next deployment does not resume it"""
+        if completed:
+            self._write("end")
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+class Backup(object):
+    """Collection of the files displaced by the 'backup' conflict policy.
+
+    Displaced files and folders are moved into the staging folder `folder`,
+    keeping their path relative to `home`. When the Backup is closed, the
+    staging folder is packed into a single archive `folder`.tar.gz. By
+    default, `folder` is `home`/.dotfiles_backup_{timestamp}.
+    """
+
+    def __init__(self, home, folder=None):
+        if folder is None:
+            folder = os.path.join(
+                home, ".dotfiles_backup_%s" % time.strftime("%Y%m%d-%H%M%S")
+            )
+            base_folder = folder
+            i = 0
+            while os.path.exists(folder) or os.path.exists(folder + ".tar.gz"):
+                i += 1
+                folder = "%s_%d" % (base_folder, i)
+        self.home = home
+        self.folder = folder
+        self.archive = folder + ".tar.gz"
+        self.files = []
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        """Move the file or folder at `path` into the backup"""
+        abs_path = os.path.abspath(path)
+        name = os.path.relpath(abs_path, os.path.abspath(self.home))
+        if name.startswith(os.pardir):
+            name = abs_path.lstrip(os.sep)  # outside of home
+        with self._lock:
+            staged = os.path.join(self.folder, name)
+            mkdir(os.path.split(staged)[0])
+            shutil.move(abs_path, staged)
+            self.files.append(name)
+
+    def close(self):
+        """Write all backed-up files to the archive in a single pass, and
+        remove the staging folder. Return the path of the archive, or None if
+        there were no files to back up"""
+        with self._lock:
+            if len(self.files) == 0:
+                return None
+            with tarfile.open(self.archive, "w:gz") as tar:
+                for name in self.files:
+                    tar.add(os.path.join(self.folder, name), arcname=name)
+            shutil.rmtree(self.folder)
+            self.files = []
+            return self.archive
+
+
+def conflict_policy(options):
+    """Return the policy for resolving conflicts with existing files.
+
+    This is `options.conflict` if it is set, 'overwrite' if
+    `options.overwrite` is True, and None otherwise.
+    """
+    policy = getattr(options, "conflict", None)
+    if policy is None and options.overwrite:
+        policy = "overwrite"
+    return policy
+
+
+class Deployment(object):
+    """Context of a deployment of dotfiles.
+
+    Attributes:
+
+    * `home`: the folder into which the dotfiles are deployed (default: HOME)
+    * `dotfiles`: the checkout of the dotfiles (default: DOTFILES)
+    * `options`: the parsed command line options (default: the result of
+      `get_options` for an empty command line)
+    * `config_home`: the folder for configuration files (default:
+      $XDG_CONFIG_HOME, or `home`/.config)
+    * `journal`: the Journal in which all operations are recorded, or None
+    * `backup`: the Backup of files displaced by the 'backup' conflict policy,
+      created when the first file is displaced
+    * `counts`: a dict counting the links created ('links') and removed
+      ('removed'), the repos cloned ('clones'), the files downloaded
+      ('downloads'), and the files backed up ('backups')
+    * `fs_lock`: a re-entrant lock held while changing files and links in
+      `home`, so that steps of `run_spec` running in parallel do not
+      interfere with each other, and interactive prompts do not interleave
+
+    Deployments do not share any state, so several deployments can run in
+    different threads of the same process. The module-level routines
+    (`make_link`, `make_links`, `get`, etc.) are wrappers around the methods
+    of `options.deployment`, or of a new Deployment for HOME and DOTFILES if
+    `options` does not have a `deployment` attribute.
+    """
+
+    def __init__(
+        self,
+        home=None,
+        dotfiles=None,
+        options=None,
+        journal=None,
+        config_home=None,
+    ):
+        if home is None:
+            home = HOME
+        if dotfiles is None:
+            dotfiles = DOTFILES
+        if options is None:
+            options = get_options([])
+        if config_home is None:
+            config_home = os.environ.get(
+                "XDG_CONFIG_HOME", os.path.join(home, ".config")
+            )
+        self.home = home
+        self.dotfiles = dotfiles
+        self.options = options
+        self.config_home = config_home
+        self.journal = journal
+        self.backup = None
+        self.counts = {
+            "links": 0,
+            "removed": 0,
+            "clones": 0,
+            "downloads": 0,
+            "backups": 0,
+        }
+        self._git_files = {}  # cache for `git_files`
+        self._lock = threading.Lock()
+        self.fs_lock = threading.RLock()
+
+    def close(self):
+        """Close the journal (without marking the deployment as completed),
+        and write the archive of all backed-up files"""
+        if self.journal is not None:
+            self.journal.close()
+        with self._lock:
+            current = self.backup
+            self.backup = None
+        if current is not None:
+            archive = current.close()
+            if archive is not None and not self.options.quiet:
+                print("Backed up displaced files to %s" % archive)
+
+    def count(self, name):
+        """Increment the counter `name` in `counts`"""
+        with self._lock:
+            self.counts[name] += 1
+
+    def _journal_key(self, operation, key):
+        """Return the key under which `operation` is journaled: the absolute
+        path for operations on files, and `key` unchanged otherwise (e.g.
+        the name of a deploy spec step)"""
+        if operation in JOURNAL_PATH_OPERATIONS:
+            return os.path.abspath(key)
+        return key
+
+    def _journal_begin(self, operation, key):
+        if self.journal is not None:
+            self.journal.begin(operation, self._journal_key(operation, key))
+
+    def _journal_done(self, operation, key):
+        if self.journal is not None:
+            self.journal.done(operation, self._journal_key(operation, key))
+
+    def _journal_is_done(self, operation, key):
+        if self.journal is not None:
+            return self.journal.is_done(
+                operation, self._journal_key(operation, key)
+            )
+        return False
 
-    src is a path relative to DOTFILES
-    dst is a path relative to HOME
+    def backup_file(self, path):
+        """Move the file or folder at `path` into the `backup`"""
+        with self._lock:
+            if self.backup is None:
+                self.backup = Backup(self.home)
+            current = self.backup
+        if not self.options.quiet:
+            print("backing up %s" % path)
+        current.add(path)
+        self.count("backups")
+
+    def resolve_conflict(self, path):
+        """Resolve the conflict of the existing file or folder `path` with a
+        file that is to be deployed, according to `conflict_policy(options)`:
+
+        * 'backup': move `path` into the `backup`
+        * 'skip': leave `path` alone and print a warning
+        * 'overwrite': remove `path`
+        * 'fail': raise an OSError
+
+        Return True if `path` was removed, False otherwise.
+        """
+        options = self.options
+        policy = conflict_policy(options)
+        if policy == "backup":
+            self.backup_file(path)
+            return True
+        elif policy == "skip":
+            if not options.quiet:
+                print("WARNING: skipping existing %s" % path)
+            return False
+        elif policy == "overwrite":
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            return True
+        elif policy == "fail":
+            raise OSError("%s already exists" % path)
+        else:
+            raise ValueError("Invalid conflict policy %s" % policy)
 
-    If options.overwrite is True and dst already exists, remove the
-    existing file before creating the link.
+    def make_link(self, src, dst):
+        """Create a symbolic link pointing to src named dst.
 
-    If options.uninstall is True, don't create any symbolic links, but
-    remove them if they exist. Any empty folder that results from this will
-    also be deleted.
+        src is a path relative to `dotfiles`
+        dst is a path relative to `home`
 
-    If the dst already exists and is a symbolic link to src, the routine
-    will exit silently.
+        If options.overwrite is True and dst already exists, remove the
+        existing file before creating the link.
 
-    For every newly created link, a message will be printed to screen,
-    unless options.quiet is given als False
+        If options.conflict is set, any existing file at dst or at its parent
+        folder is handled according to that policy, see `resolve_conflict`.
+        If the conflict is skipped, no link is created. Otherwise, an existing
+        file at the parent folder is only replaced after confirmation.
 
-    Raises OSError if an operation cannot be completed
-    """
-    global input
-    abs_src = os.path.join(DOTFILES, src)
-    abs_dst = os.path.join(HOME, dst)
-    dst_path = os.path.split(abs_dst)[0]
-    if options.overwrite and not options.uninstall:
-        if is_file_or_link(abs_dst):
-            os.unlink(abs_dst)
-        elif os.path.isdir(abs_dst):
-            if os.path.isdir(abs_src):
-                shutil.rmtree(abs_dst)
+        If options.uninstall is True, don't create any symbolic links, but
+        remove them if they exist. Any empty folder that results from this
+        will also be deleted.
+
+        If the dst already exists and is a symbolic link to src, the routine
+        will exit silently.
+
+        For every newly created link, a message will be printed to screen,
+        unless options.quiet is given als False
+
+        Raises OSError if an operation cannot be completed
+        """
+        options = self.options
+        abs_src = os.path.join(self.dotfiles, src)
+        abs_dst = os.path.join(self.home, dst)
+        dst_path = os.path.split(abs_dst)[0]
+        if self._journal_is_done("link", abs_dst):
+            return
+        policy = conflict_policy(options)
+        if policy == "overwrite" and not options.uninstall:
+            if is_file_or_link(abs_dst):
+                os.unlink(abs_dst)
+            elif os.path.isdir(abs_dst):
+                if os.path.isdir(abs_src):
+                    shutil.rmtree(abs_dst)
+                else:
+                    raise OSError(
+                        "Existing directory %s " % abs_dst
+                        + "would be overwritten by file %s" % abs_src
+                    )
+        link_file = abs_dst
+        link_target = os.path.relpath(abs_src, dst_path)
+        if options.uninstall:
+            if os.path.realpath(abs_dst) == os.path.realpath(abs_src):
+                if not options.quiet:
+                    print("removing %s" % abs_dst)
+                os.unlink(abs_dst)
+                self.count("removed")
+                # remove empty folder
+                try:
+                    folder = os.path.split(abs_dst)[0]
+                    while folder != "":
+                        os.rmdir(folder)
+                        folder = os.path.split(folder)[0]
+                except OSError:
+                    pass  # folder is not empty
+        else:
+            if os.path.realpath(abs_dst) != os.path.realpath(abs_src):
+                if not options.quiet:
+                    print("%s -> %s" % (link_file, abs_src))
+                if is_file_or_link(dst_path):
+                    if getattr(options, "conflict", None) is None:
+                        if not options.quiet:
+                            overwrite = input(
+                                "%s already exists as a file. Overwrite with "
+                                "an empty folder? yes/[no]: " % dst_path
+                            )
+                            if overwrite.lower().strip() == "yes":
+                                os.unlink(dst_path)
+                    elif not self.resolve_conflict(dst_path):
+                        return
+                mkdir(dst_path)
+                if getattr(options, "conflict", None) is None:
+                    if is_file_or_link(link_file) and not options.quiet:
+                        overwrite = input(
+                            "%s already exists. Overwrite? yes/[no]: "
+                            % link_file
+                        )
+                        if overwrite.lower().strip() == "yes":
+                            os.unlink(link_file)
+                elif os.path.lexists(link_file):
+                    if not self.resolve_conflict(link_file):
+                        return
+                os.symlink(link_target, link_file)
+                self.count("links")
+        self._journal_done("link", abs_dst)
+
+    def make_links(
+        self,
+        folder,
+        recursive=True,
+        target=".",
+        log_fh=None,
+        ignore=(".DS_Store", "*~"),
+        use_git=False,
+    ):
+        """For every file in the given `folder`, create a link inside the
+        `target`.
+
+        `folder` is the path of a folder, relative to `dotfiles`.
+        `target` is the path of a folder in which to create the links,
+                 relative to `home`
+        If `recursive` is True, links are also generated for all all
+        subfolders of `folder`
+        `ignore` is an iterable of filename patterns. Any file or subfolder in
+        `folder` matching a pattern in `ignore` is ignored. Subfolders are
+        linked with the default `ignore` patterns.
+        If `use_git` is True, only the files tracked by git are linked. These
+        are obtained with `git_files`, instead of by walking the `folder`.
+        Untracked files (editor swap files, build artifacts, etc.) are never
+        linked. This includes the files in git submodules, which are linked
+        if they are tracked by the submodule. In this case, `ignore` applies
+        to the files and subfolders at any depth, and tracked files that are
+        missing from the working tree (including submodules that are not
+        initialized) are skipped with a warning.
+
+        A list of all generated link destinations is written to the given
+        `log_fh`. Each line contains the absolute path of the link and the
+        absolute path of the linked file in `dotfiles`, separated by a tab.
+        If `log_fh` is None, a new file `dotfiles`/.{folder}.links will be
+        opened and used for `log_fh`. If that file already exists, it will be
+        overwritten; the original file will be copied to have the 'old_links'
+        extension.
+        """
+        options = self.options
+        close_log = False
+        if log_fh is None:
+            log_filename = os.path.join(
+                self.dotfiles, ".%s.links" % folder.replace("/", "_")
+            )
+            if os.path.isfile(log_filename):
+                os.rename(
+                    log_filename, change_extension(log_filename, "old_links")
+                )
+            log_fh = open(log_filename, "w")
+            close_log = True
+        if use_git:
+            for mode, src in self.git_files(folder):
+                rel_path = os.path.relpath(src, folder)
+                parts = rel_path.split(os.sep)
+                if len(parts) > 1 and not recursive:
+                    continue
+                if any(
+                    [fnmatch(part, pat) for part in parts for pat in ignore]
+                ):
+                    continue
+                dst = rel_path
+                if target != ".":
+                    dst = os.path.join(target, dst)
+                if not os.path.lexists(os.path.join(self.dotfiles, src)):
+                    if not options.quiet:
+                        print("WARNING: %s is missing, not linked" % src)
+                    continue
+                if mode == "160000":
+                    # submodule that is not checked out: no files to link
+                    if not options.quiet:
+                        print("WARNING: submodule %s is not initialized" % src)
+                    continue
+                self.make_link(src, dst)
+                if not options.uninstall:
+                    self._write_link_log(log_fh, dst, src)
+        else:
+            files = [
+                os.path.join(self.dotfiles, folder, file)
+                for file in os.listdir(os.path.join(self.dotfiles, folder))
+            ]
+            for file in files:  # file is relative to CWD
+                filename = os.path.basename(file)
+                if any([fnmatch(filename, pat) for pat in ignore]):
+                    continue
+                src = os.path.relpath(file, self.dotfiles)
+                dst = os.path.relpath(
+                    file, os.path.join(self.dotfiles, folder)
+                )
+                if target != ".":
+                    dst = os.path.join(target, dst)
+                if os.path.isfile(file):
+                    self.make_link(src, dst)
+                    if not options.uninstall:
+                        self._write_link_log(log_fh, dst, src)
+                elif os.path.isdir(file):
+                    if recursive:
+                        self.make_links(src, recursive, dst, log_fh)
+                else:
+                    raise AssertionError(
+                        "%s is neither a file nor a folder" % file
+                    )
+        if close_log:
+            log_fh.close()
+
+    def _write_link_log(self, log_fh, dst, src):
+        """Write the link `dst` (relative to `home`) to `src` (relative to
+        `dotfiles`) to the link log `log_fh`"""
+        log_fh.write(
+            "%s\t%s\n"
+            % (
+                os.path.abspath(os.path.join(self.home, dst)),
+                os.path.abspath(os.path.join(self.dotfiles, src)),
+            )
+        )
+
+    def git_files(self, folder):
+        """Return a list of tuples (mode, path) for all files in the given
+        `folder` (relative to `dotfiles`) that are tracked by git.
+
+        The list is obtained from the git index (and the index of any
+        submodule) with a single call to `git ls-files`, and cached for the
+        lifetime of the Deployment. Each `path` is relative to `dotfiles`, and
+        `mode` is the mode string recorded by git: '100644' for regular files,
+        '100755' for executables, '120000' for symbolic links, and '160000'
+        for submodules that are not initialized.
+        """
+        with self._lock:
+            if folder in self._git_files:
+                return self._git_files[folder]
+        cmd = [
+            "git",
+            "ls-files",
+            "-s",
+            "-z",
+            "--recurse-submodules",
+            "--",
+            folder,
+        ]
+        output = check_output(cmd, cwd=self.dotfiles).decode("utf-8")
+        files = []
+        seen = set()
+        for record in output.split("\0"):
+            if not record:
+                continue
+            info, path = record.split("\t", 1)
+            if path in seen:
+                continue  # unmerged paths are listed for every stage
+            seen.add(path)
+            files.append((info.split()[0], path.replace("/", os.sep)))
+        with self._lock:
+            self._git_files[folder] = files
+        return files
+
+    def link_logs(self):
+        """Return a sorted list of all link logs written by `make_links`"""
+        return sorted(glob(os.path.join(self.dotfiles, ".*.links")))
+
+    def verify_links(self, log_files=None, processes=16):
+        """Check the links recorded in the given link logs, without changing
+        anything.
+
+        `log_files` is a list of link logs as written by `make_links`. If
+        None, all logs returned by `link_logs` are used. For every log, the
+        log with the 'old_links' extension from the previous run of
+        `make_links` is checked as well, if it exists.
+
+        Return a dict that maps the categories 'missing', 'broken', 'foreign',
+        and 'stale' to a sorted list of affected links:
+
+        * 'missing': a logged link does not exist
+        * 'broken': a logged link points to a file that does not exist
+        * 'foreign': a logged link was replaced by a file or folder, or by a
+          link pointing somewhere else
+        * 'stale': a link from the previous run of `make_links` is no longer
+          part of the deployment, but still exists
+
+        All checks are done in a pool of `processes` threads.
+        """
+        if log_files is None:
+            log_files = self.link_logs()
+        entries = []
+        old_links = set()
+        for log_filename in log_files:
+            entries.extend(read_link_log(log_filename))
+            old_log_filename = change_extension(log_filename, "old_links")
+            if os.path.isfile(old_log_filename):
+                old_links.update(
+                    link for (link, source) in read_link_log(old_log_filename)
+                )
+        old_links = sorted(
+            old_links - set(link for (link, source) in entries)
+        )
+        pool = ThreadPool(processes)
+        try:
+            link_results = pool.map(_check_link, entries)
+            stale_results = pool.map(_check_stale, old_links)
+        finally:
+            pool.close()
+            pool.join()
+        problems = {"missing": [], "broken": [], "foreign": [], "stale": []}
+        links = [link for (link, source) in entries] + old_links
+        for link, category in zip(links, link_results + stale_results):
+            if category is not None:
+                problems[category].append(link)
+        for category in problems:
+            problems[category].sort()
+        return problems
+
+    def deploy_vim(self, repo):
+        """Deploy vimrc from the given git repository.
+
+        If ~/.vim does not exist already, the given repo will be cloned to
+        ~/.vim, and a symlink ~/.vimrc -> ~/.vim/init.vim will be created, as
+        well as a symlink $XDG_CONFIG_HOME/nvim -> ~/.vim (where
+        $XDG_CONFIG_HOME is `config_home`)
+
+        If ~/.vim does exist and is a git repository, it will be updated to
+        the latest revision.
+
+        If options.overwrite is True, and ~/.vim/vimrc exists, any existing
+        file ~/.vimrc will be removed and be replaced with a symlink to
+        ~/.vim/init.vim. Likewise, $XDG_CONFIG_HOME/nvim will be replaced.
+
+        The flag options.uninstall will only affect the file ~/.vimrc and the
+        link $XDG_CONFIG_HOME/nvim; the .vim folder is never touched. This is
+        so that spell check files, buffers, etc. don't get deleted
+        accidentally
+        """
+        options = self.options
+        vimdir = os.path.join(self.home, ".vim")
+        vimrc = os.path.join(self.home, ".vimrc")
+        vimrc_target = os.path.join(vimdir, "init.vim")
+        nvimdir = os.path.join(self.config_home, "nvim")
+        self.deploy_repo(repo, ".vim", allow_uninstall="no")
+        with self.fs_lock:
+            # link for standard vim
+            if os.path.isfile(vimrc_target):
+                if conflict_policy(options) == "overwrite":
+                    if is_file_or_link(vimrc):
+                        os.unlink(vimrc)
+                self.make_link(
+                    os.path.abspath(vimrc_target), os.path.abspath(vimrc)
+                )
             else:
-                raise OSError(
-                    "Existing directory %s " % abs_dst
-                    + "would be overwritten by file %s" % abs_src
+                if not options.uninstall and not options.quiet:
+                    print("WARNING: Cannot link to %s" % vimrc_target)
+            # link for neovim
+            if os.path.isdir(vimdir):
+                mkdir(self.config_home)
+                self.make_link(
+                    os.path.abspath(vimdir), os.path.abspath(nvimdir)
                 )
-    link_file = abs_dst
-    link_target = os.path.relpath(abs_src, dst_path)
-    if options.uninstall:
-        if os.path.realpath(abs_dst) == os.path.realpath(abs_src):
+            else:
+                if not options.uninstall and not options.quiet:
+                    print("WARNING: Cannot link to %s" % vimdir)
+
+    def deploy_neovim(self, neovim_repo, vim_repo=None):
+        """Deploy neovim configuration from the given git repository.
+
+        It is deployed to $XDG_CONFIG_HOME/nvim, where $XDG_CONFIG_HOME is
+        `config_home`.
+
+        If `vim_repo` is given, a vim configuration will be set up parallel to
+        the neovim configuration. It is deployed to $XDG_CONFIG_HOME/nvim and
+        linked to `~/.vim` and `~/.vimrc`. Legacy `vim` will automatically
+        pick up this configuration. Also, `nvim` can pick up the
+        vim-configuration by starting it as `NVIM_APPNAME=vim nvim`.
+
+        If options.overwrite is True, and ~/.vim/vimrc exists, any existing
+        file ~/.vimrc will be removed and be replaced with a symlink to
+        ~/.vim/init.vim. Likewise, $XDG_CONFIG_HOME/nvim will be replaced.
+
+        The flags options.overwrite and options.uninstall will only affect
+        symlinks, but it will not delete the checkouts of the configuration
+        repos. This is so that spell check files, buffers, etc. don't get
+        deleted accidentally.
+        """
+        options = self.options
+        nvimdir = os.path.join(self.config_home, "nvim")
+        vimdir = os.path.join(self.config_home, "vim")
+        vimdir_home = os.path.join(self.home, ".vim")
+        vimrc = os.path.join(self.home, ".vimrc")
+        vimrc_target = os.path.join(vimdir, "init.vim")
+        if vim_repo is not None:
+            self.deploy_repo(vim_repo, vimdir, allow_uninstall="no")
+            with self.fs_lock:
+                # link ~/.vimrc (for legacy vim)
+                if os.path.isfile(vimrc_target):
+                    if conflict_policy(options) == "overwrite":
+                        if is_file_or_link(vimrc):
+                            os.unlink(vimrc)
+                    self.make_link(
+                        os.path.abspath(vimrc_target), os.path.abspath(vimrc)
+                    )
+                else:
+                    if not options.uninstall and not options.quiet:
+                        print("WARNING: Cannot link to %s" % vimrc_target)
+                # link ~/.vim (for legacy vim)
+                if os.path.isdir(vimdir):
+                    if conflict_policy(options) == "overwrite":
+                        if is_file_or_link(vimdir_home):
+                            os.unlink(vimdir_home)
+                    self.make_link(
+                        os.path.abspath(vimdir), os.path.abspath(vimdir_home)
+                    )
+                else:
+                    if not options.uninstall and not options.quiet:
+                        print("WARNING: Cannot link to %s" % vimdir)
+        self.deploy_repo(neovim_repo, nvimdir, allow_uninstall="no")
+
+    def deploy_repo(
+        self, repo, destination, branch="master", allow_uninstall="clean"
+    ):
+        """Create a checkout of the given `repo` and `branch` at `destination`
+        (relative to `home`), if `destination` does not exist yet.
+
+        If `destination` exists (and `options.uninstall` is False), do one of
+        the following:
+        * If `destination` is a git checkout, update it.
+        * If `destination` is not a git checkout, replace it with a checkout
+          of `repo` if `options.overwrite` is True, otherwise print a warning
+          and exit. If `options.conflict` is set, `destination` is instead
+          handled according to that policy, see `resolve_conflict`.
+
+        If `destination` exists, is a git checkout, and `options.uninstall` is
+        True, do one of the following:
+        * If `allow_uninstall` is 'clean', remove `destination` only if `git
+          status` does not show any uncommited changes (otherwise print an
+          error and exit)
+        * If `allow_uninstall` is 'dirty', remove `destination`
+          unconditionally
+        * If `allow_uninstall` is 'no', do nothing
+        """
+        options = self.options
+        stdout = None
+        if options.quiet:
+            stdout = open(os.devnull, "w")
+        create_checkout = True
+        checkout_dir = os.path.join(self.home, destination)
+        if self._journal_is_done("deploy_repo", checkout_dir):
+            return
+        update = False
+        with self.fs_lock:
+            if os.path.exists(checkout_dir):
+                create_checkout = False
+                if options.uninstall:
+                    if os.path.exists(os.path.join(checkout_dir, ".git")):
+                        if allow_uninstall == "dirty":
+                            shutil.rmtree(checkout_dir)
+                        elif allow_uninstall == "clean":
+                            cmd = ["git", "status", "--porcelain"]
+                            status = check_output(cmd, cwd=checkout_dir)
+                            empty = status[0:0]  # same type as `status`!
+                            if status.strip() == empty:
+                                shutil.rmtree(checkout_dir)
+                            else:
+                                print(
+                                    "ERROR: Cannot uninstall %s (not clean)"
+                                    % checkout_dir
+                                )
+                        elif allow_uninstall == "no":
+                            pass
+                        else:
+                            raise ValueError(
+                                "Invalid value %s for `allow_uninstall`"
+                                % allow_uninstall
+                            )
+                    else:
+                        print(
+                            "WARNING: %s cannnot be uninstalled "
+                            "(not a git repo)" % checkout_dir
+                        )
+                else:  # update or overwrite
+                    if os.path.exists(os.path.join(checkout_dir, ".git")):
+                        update = True
+                    else:
+                        if conflict_policy(options) is None:
+                            print(
+                                "WARNING: %s already exists and will not be "
+                                "overwritten without the --overwrite option"
+                                % checkout_dir
+                            )
+                        elif self.resolve_conflict(checkout_dir):
+                            create_checkout = True
+        if update:
+            git_update(checkout_dir, options.quiet)
+        if create_checkout:
+            if not check_remote_repo(repo, options.quiet):
+                return
+            self._journal_begin("clone", checkout_dir)
+            cmd = ["git", "clone", repo, destination]
+            if not options.quiet:
+                print(" ".join(cmd))
+            ret = call(cmd, cwd=self.home, stderr=STDOUT, stdout=stdout)
+            if ret != 0:
+                if not options.quiet:
+                    print("WARNING: git returned nonzero exist status (%s)")
+                return
+            self._journal_done("clone", checkout_dir)
+            self.count("clones")
+            cmd = ["git", "checkout", branch]
             if not options.quiet:
-                print("removing %s" % abs_dst)
-            os.unlink(abs_dst)
-            # remove empty folder
+                print(" ".join(cmd))
+            ret = call(cmd, cwd=checkout_dir, stderr=STDOUT, stdout=stdout)
+            if ret != 0:
+                if not options.quiet:
+                    print("WARNING: git returned nonzero exist status (%s)")
+                return
+        self._journal_done("deploy_repo", checkout_dir)
+
+    def get(self, url, destination, make_exec=False):
+        """Download the file at the given URL to destination (relative to
+        `home`).
+
+        If `make_exec` is True, also make it executable.
+
+        If the file already exists, an `OSError` will be raised, unless
+        `options.overwrite` is True. If `options.conflict` is set, an existing
+        file is instead handled according to that policy, see
+        `resolve_conflict`.
+
+        If `options.uninstall` is True, destination will be deleted if it
+        exists.
+
+        The file is first downloaded to destination with the additional
+        extension '.part', and only renamed to destination once the download
+        is complete.
+        """
+        options = self.options
+        destination = os.path.join(self.home, destination)
+        if self._journal_is_done("get", destination):
+            return
+        with self.fs_lock:
+            mkdir(os.path.split(destination)[0])
+            if is_file_or_link(destination):
+                if options.uninstall:
+                    if not options.quiet:
+                        print("removing %s" % destination)
+                    os.unlink(destination)
+                    self._journal_done("get", destination)
+                    return
+                elif conflict_policy(options) is None:
+                    raise OSError("File %s already exists" % destination)
+                elif not self.resolve_conflict(destination):
+                    return
+            if os.path.isdir(destination):
+                if conflict_policy(options) in ["backup", "skip"]:
+                    if not self.resolve_conflict(destination):
+                        return
+                else:
+                    raise OSError("%s is folder, must be file" % destination)
+        if not options.quiet:
+            print("%s -> %s" % (url, destination))
+        partial = destination + ".part"
+        self._journal_begin("get", destination)
+        try:
+            urlretrieve(url, partial)
+        except Exception:
+            if is_file_or_link(partial):
+                os.unlink(partial)
+            raise
+        if make_exec:
+            perms = os.stat(partial)
+            # chmod a+x
+            os.chmod(
+                partial,
+                perms.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
+            )
+        with self.fs_lock:
+            os.rename(partial, destination)
+        self._journal_done("get", destination)
+        self.count("downloads")
+
+    def git_update(self, folder=None):
+        """Perform an update of the repository in the given folder (default:
+        `dotfiles`)"""
+        if folder is None:
+            folder = self.dotfiles
+        git_update(folder, self.options.quiet)
+
+    def run_duti(self, handlers="handlers.duti"):
+        """Run the duti utility for the handlers file (relative to
+        `dotfiles`)"""
+        handlers = os.path.abspath(os.path.join(self.dotfiles, handlers))
+        run_duti(self.options.quiet, handlers)
+
+    def set_crontab(self, crontab_file="~/.crontab"):
+        """Set the crontab to the given crontab_file, where '~' refers to
+        `home`"""
+        if crontab_file == "~" or crontab_file.startswith("~" + os.sep):
+            crontab_file = self.home + crontab_file[1:]
+        set_crontab(self.options.quiet, os.path.abspath(crontab_file))
+
+    def run_spec(self, spec, processes=8):
+        """Run the steps of the given deploy `spec`, respecting the
+        dependencies between them.
+
+        The `spec` is a dict, or the name of a file (relative to `dotfiles`)
+        to be read with `load_deploy_spec`. It must contain a list 'steps',
+        where each step has an 'action' (a key in DEPLOY_ACTIONS), and
+        optionally a 'name', a list of names of steps it 'requires', and a
+        dict of keyword 'args' for the action.
+
+        A step starts as soon as all the steps it requires have finished. When
+        resuming an interrupted deployment, steps completed according to the
+        `journal` are skipped.
+        Network-bound steps (cloning repos, downloads) run in parallel, in a
+        pool of `processes` threads, and only hold `fs_lock` while they change
+        files or links in `home`. The remaining filesystem steps hold
+        `fs_lock` for their entire run, so that they run one at a time and
+        interactive prompts do not interleave.
+
+        If a step raises an exception, all steps depending on it are skipped,
+        and the exception is re-raised after all other steps have finished.
+        """
+        options = self.options
+        if not isinstance(spec, dict):
+            spec = load_deploy_spec(
+                os.path.abspath(os.path.join(self.dotfiles, spec))
+            )
+        pending = deploy_steps(spec)
+        finished_queue = Queue()
+
+        def run_step(step):
+            if self._journal_is_done("step", step["name"]):
+                finished_queue.put((step["name"], None))
+                return
+            func, network = DEPLOY_ACTIONS[step["action"]]
             try:
-                folder = os.path.split(abs_dst)[0]
-                while folder != "":
-                    os.rmdir(folder)
-                    folder = os.path.split(folder)[0]
-            except OSError:
-                pass  # folder is not empty
+                if network:
+                    func(self, **step["args"])
+                else:
+                    with self.fs_lock:
+                        func(self, **step["args"])
+            except Exception as exc:
+                finished_queue.put((step["name"], exc))
+            else:
+                self._journal_done("step", step["name"])
+                finished_queue.put((step["name"], None))
+
+        done = set()
+        failed = set()
+        errors = []
+        running = 0
+        pool = ThreadPool(processes)
+        try:
+            while pending or running > 0:
+                blocked = [
+                    step
+                    for step in pending
+                    if any([name in failed for name in step["requires"]])
+                ]
+                while blocked:
+                    for step in blocked:
+                        if not options.quiet:
+                            print("WARNING: skipping step %s" % step["name"])
+                        failed.add(step["name"])
+                        pending.remove(step)
+                    blocked = [
+                        step
+                        for step in pending
+                        if any([name in failed for name in step["requires"]])
+                    ]
+                ready = [
+                    step
+                    for step in pending
+                    if all([name in done for name in step["requires"]])
+                ]
+                for step in ready:
+                    pending.remove(step)
+                    pool.apply_async(run_step, (step,))
+                    running += 1
+                if running == 0:
+                    break
+                name, exc = finished_queue.get()
+                running -= 1
+                if exc is None:
+                    done.add(name)
+                else:
+                    if not options.quiet:
+                        print("ERROR: step %s failed: %s" % (name, exc))
+                    failed.add(name)
+                    errors.append(exc)
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+
+    def bench(self, commands=None, runs=10):
+        """Measure the startup time of interactive tools with the
+        configuration deployed in `home`.
+
+        `commands` is a dict that maps the name of each tool to the command
+        (list of arguments) that starts and immediately exits it, see
+        BENCH_COMMANDS (the default). Tools that are not installed are
+        skipped. Every command is run `runs` times, with HOME set to `home`
+        and XDG_CONFIG_HOME set to `config_home`. If the command contains the
+        placeholder {startuptime}, the time reported by the tool itself in
+        that file is used instead of the wall time of the command.
+
+        Return a dict that maps the name of each tool to a dict with the
+        'median', 'p90', and 'max' startup time, in seconds. If the command
+        for a tool fails or times out (see `startup_time`), the dict for that
+        tool instead contains the error message as 'error'.
+        """
+        if commands is None:
+            commands = BENCH_COMMANDS
+        env = dict(os.environ)
+        if os.path.abspath(self.home) != os.path.abspath(HOME):
+            for name in ["XDG_DATA_HOME", "XDG_STATE_HOME", "XDG_CACHE_HOME"]:
+                env.pop(name, None)
+        env["HOME"] = os.path.abspath(self.home)
+        env["XDG_CONFIG_HOME"] = os.path.abspath(self.config_home)
+        results = {}
+        for tool in sorted(commands):
+            if which(commands[tool][0]) is None:
+                if not self.options.quiet:
+                    print("WARNING: %s is not available" % commands[tool][0])
+                continue
+            try:
+                times = [
+                    startup_time(commands[tool], env) for i in range(runs)
+                ]
+            except OSError as exc:
+                if not self.options.quiet:
+                    print("WARNING: %s" % exc)
+                results[tool] = {"error": str(exc)}
+                continue
+            results[tool] = {
+                "median": percentile(times, 50),
+                "p90": percentile(times, 90),
+                "max": max(times),
+            }
+        return results
+
+
+@contextmanager
+def _deployment(options):
+    """Yield `options.deployment`, or a new Deployment for `options` that is
+    closed afterwards"""
+    deployment = getattr(options, "deployment", None)
+    if deployment is not None:
+        yield deployment
     else:
-        if os.path.realpath(abs_dst) != os.path.realpath(abs_src):
-            if not options.quiet:
-                print("%s -> %s" % (link_file, abs_src))
-            if is_file_or_link(dst_path) and not options.quiet:
-                overwrite = input(
-                    "%s already exists as a file. Overwrite with "
-                    "an empty folder? yes/[no]: " % dst_path
-                )
-                if overwrite.lower().strip() == "yes":
-                    os.unlink(dst_path)
-            mkdir(dst_path)
-            if is_file_or_link(link_file) and not options.quiet:
-                overwrite = input(
-                    "%s already exists. Overwrite? yes/[no]: " % link_file
-                )
-                if overwrite.lower().strip() == "yes":
-                    os.unlink(link_file)
-            os.symlink(link_target, link_file)
+        deployment = Deployment(options=options)
+        try:
+            yield deployment
+        finally:
+            deployment.close()
+
+
+def make_link(src, dst, options):
+    """Create a symbolic link pointing to src (relative to DOTFILES) named dst
+    (relative to HOME). See `Deployment.make_link`"""
+    with _deployment(options) as deployment:
+        deployment.make_link(src, dst)
 
 
 def change_extension(filename, new_ext):
@@ -138,53 +1214,91 @@ def make_links(
     target=".",
     log_fh=None,
     ignore=(".DS_Store", "*~"),
+    use_git=False,
 ):
-    """For every file in the given `folder`, create a link inside the `target`.
-
-    `folder` is the path of a folder, relative to DOTFILES.
-    `target` is the path of a folder in which to create the links, relative to
-             HOME
-    `options` are passed to the `make_link` routine
-    If `recursive` is True, links are also generated for all all subfolders of
-    `folder`
-    `ignore` is an iterable of filename patterns. Any file in `folder` matching
-    a pattern in `ignore` is ignored.
-
-    A list of all generated link destinations is written to the given `log_fh`.
-    If `log_fh` is None, a new file DOTFILES/.{folder}.links will be opened and
-    used for `log_fh`. If that file already exists, it will be overwritten; the
-    original file will be copied to have the 'old_links' extension.
+    """For every file in the given `folder` (relative to DOTFILES), create a
+    link inside the `target` (relative to HOME). See `Deployment.make_links`
     """
-    files = [
-        os.path.join(DOTFILES, folder, file)
-        for file in os.listdir(os.path.join(DOTFILES, folder))
-    ]
-    if log_fh is None:
-        log_filename = os.path.join(
-            DOTFILES, ".%s.links" % folder.replace("/", "_")
+    with _deployment(options) as deployment:
+        deployment.make_links(
+            folder, recursive, target, log_fh, ignore, use_git
         )
-        if os.path.isfile(log_filename):
-            os.rename(
-                log_filename, change_extension(log_filename, "old_links")
-            )
-        log_fh = open(log_filename, "w")
-    for file in files:  # file is relative to CWD
-        filename = os.path.basename(file)
-        if any([fnmatch(filename, pat) for pat in ignore]):
-            continue
-        src = os.path.relpath(file, DOTFILES)
-        dst = os.path.relpath(file, os.path.join(DOTFILES, folder))
-        if target != ".":
-            dst = os.path.join(target, dst)
-        if os.path.isfile(file):
-            make_link(src, dst, options)
-            if not options.uninstall:
-                log_fh.write("%s\n" % os.path.abspath(os.path.join(HOME, dst)))
-        elif os.path.isdir(file):
-            if recursive:
-                make_links(src, options, recursive, dst, log_fh)
-        else:
-            raise AssertionError("%s is neither a file nor a folder" % file)
+
+
+def git_files(folder):
+    """Return a list of tuples (mode, path) for all files in the given `folder`
+    (relative to DOTFILES) that are tracked by git. See
+    `Deployment.git_files`"""
+    return Deployment().git_files(folder)
+
+
+def link_logs():
+    """Return a sorted list of all link logs written by `make_links`"""
+    return Deployment().link_logs()
+
+
+def read_link_log(log_filename):
+    """Read a link log written by `make_links`.
+
+    Return a list of tuples (link, source) of absolute paths. For logs written
+    by older versions of `make_links`, which only contain the link, `source`
+    is None.
+    """
+    entries = []
+    with open(log_filename) as in_fh:
+        for line in in_fh:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if "\t" in line:
+                link, source = line.split("\t", 1)
+            else:
+                link, source = line, None
+            entries.append((link, source))
+    return entries
+
+
+def _check_link(entry):
+    """Return the problem category of the logged (link, source) `entry`, or
+    None if the link is in order. Only uses `lstat` and `readlink`, except to
+    resolve symlinks in the path of a link that looks foreign."""
+    link, source = entry
+    try:
+        st = os.lstat(link)
+    except OSError:
+        return "missing"
+    if not stat.S_ISLNK(st.st_mode):
+        return "foreign"
+    target = os.path.join(os.path.dirname(link), os.readlink(link))
+    if not os.path.exists(target):
+        return "broken"
+    if source is not None:
+        if os.path.normpath(target) != os.path.normpath(source):
+            if os.path.realpath(target) != os.path.realpath(source):
+                return "foreign"
+    return None
+
+
+def _check_stale(link):
+    """Return 'stale' if `link` (from an outdated link log) still exists as a
+    symbolic link, None otherwise"""
+    if os.path.islink(link):
+        return "stale"
+    return None
+
+
+def verify_links(log_files=None, processes=16):
+    """Check the links recorded in the given link logs (default: all link logs
+    in DOTFILES), without changing anything. See `Deployment.verify_links`"""
+    return Deployment().verify_links(log_files, processes)
+
+
+def print_verification(problems):
+    """Print a summary of the `problems` returned by `verify_links`"""
+    for category in ["missing", "broken", "foreign", "stale"]:
+        print("%s: %d" % (category, len(problems[category])))
+        for link in problems[category]:
+            print("    %s" % link)
 
 
 def which(program):
@@ -210,105 +1324,17 @@ def which(program):
 
 
 def deploy_vim(repo, options):
-    """Deploy vimrc from the given git repository.
-
-    If ~/.vim does not exist already, the given repo will be cloned to
-    ~/.vim, and a symlink ~/.vimrc -> ~/.vim/init.vim will be created, as
-    well as a symlink $XDG_CONFIG_HOME/nvim -> ~/.vim (where
-    $XDG_CONFIG_HOME defaults to ~/.config)
-
-    If ~/.vim does exist and is a git repository, it will be updated to the
-    latest revision.
-
-    If options.overwrite is True, and ~/.vim/vimrc exists, any existing
-    file ~/.vimrc will be removed and be replaced with a symlink to
-    ~/.vim/init.vim. Likewise, $XDG_CONFIG_HOME/nvim will be replaced.
-
-    The flag options.uninstall will only affect the file ~/.vimrc and the
-    link $XDG_CONFIG_HOME/nvim; the .vim folder is never touched. This is
-    so that spell check files, buffers, etc. don't get deleted accidentally
-    """
-    XDG_CONFIG_HOME = os.environ.get(
-        "XDG_CONFIG_HOME", os.path.join(HOME, ".config")
-    )
-    vimdir = os.path.join(HOME, ".vim")
-    vimrc = os.path.join(HOME, ".vimrc")
-    vimrc_target = os.path.join(vimdir, "init.vim")
-    nvimdir = os.path.join(XDG_CONFIG_HOME, "nvim")
-    deploy_repo(repo, ".vim", options, allow_uninstall="no")
-    # link for standard vim
-    if os.path.isfile(vimrc_target):
-        if options.overwrite:
-            if is_file_or_link(vimrc):
-                os.unlink(vimrc)
-        make_link(
-            os.path.abspath(vimrc_target), os.path.abspath(vimrc), options
-        )
-    else:
-        if not options.uninstall and not options.quiet:
-            print("WARNING: Cannot link to %s" % vimrc_target)
-    # link for neovim
-    if os.path.isdir(vimdir):
-        mkdir(XDG_CONFIG_HOME)
-        make_link(os.path.abspath(vimdir), os.path.abspath(nvimdir), options)
-    else:
-        if not options.uninstall and not options.quiet:
-            print("WARNING: Cannot link to %s" % vimdir)
+    """Deploy vimrc from the given git repository to ~/.vim. See
+    `Deployment.deploy_vim`"""
+    with _deployment(options) as deployment:
+        deployment.deploy_vim(repo)
 
 
 def deploy_neovim(neovim_repo, options, vim_repo=None):
-    """Deploy neovim configuration from the given git repository.
-
-    It is deployed to $XDG_CONFIG_HOME/nvim.
-
-    If `vim_repo` is given, a vim configuration will be set up parallel to the
-    neovim configuration. It is deployed to $XDG_CONFIG_HOME/nvim and linked to
-    `~/.vim` and `~/.vimrc`. Legacy `vim` will automatically pick up this
-    configuration. Also, `nvim` can pick up the vim-configuration by starting
-    it as `NVIM_APPNAME=vim nvim`.
-
-    If options.overwrite is True, and ~/.vim/vimrc exists, any existing
-    file ~/.vimrc will be removed and be replaced with a symlink to
-    ~/.vim/init.vim. Likewise, $XDG_CONFIG_HOME/nvim will be replaced.
-
-    The flags options.overwrite and options.uninstall will only affect
-    symlinks, but it will not delete the checkouts of the configuration repos.
-    This is so that spell check files, buffers, etc. don't get deleted
-    accidentally.
-    """
-    XDG_CONFIG_HOME = os.environ.get(
-        "XDG_CONFIG_HOME", os.path.join(HOME, ".config")
-    )
-    nvimdir = os.path.join(XDG_CONFIG_HOME, "nvim")
-    vimdir = os.path.join(XDG_CONFIG_HOME, "vim")
-    vimdir_home = os.path.join(HOME, ".vim")
-    vimrc = os.path.join(HOME, ".vimrc")
-    vimrc_target = os.path.join(vimdir, "init.vim")
-    if vim_repo is not None:
-        deploy_repo(vim_repo, vimdir, options, allow_uninstall="no")
-        # link ~/.vimrc (for legacy vim)
-        if os.path.isfile(vimrc_target):
-            if options.overwrite:
-                if is_file_or_link(vimrc):
-                    os.unlink(vimrc)
-            make_link(
-                os.path.abspath(vimrc_target), os.path.abspath(vimrc), options
-            )
-        else:
-            if not options.uninstall and not options.quiet:
-                print("WARNING: Cannot link to %s" % vimrc_target)
-        # link ~/.vim (for legacy vim)
-        if os.path.isdir(vimdir):
-            if options.overwrite:
-                if is_file_or_link(vimdir_home):
-                    os.unlink(vimdir_home)
-            make_link(
-                os.path.abspath(vimdir), os.path.abspath(vimdir_home), options
-            )
-        else:
-            if not options.uninstall and not options.quiet:
-                print("WARNING: Cannot link to %s" % vimdir)
-    deploy_repo(neovim_repo, nvimdir, options, allow_uninstall="no")
+    """Deploy neovim configuration from the given git repository to
+    $XDG_CONFIG_HOME/nvim. See `Deployment.deploy_neovim`"""
+    with _deployment(options) as deployment:
+        deployment.deploy_neovim(neovim_repo, vim_repo)
 
 
 def check_remote_repo(repo, quiet=False):
@@ -331,87 +1357,10 @@ def check_remote_repo(repo, quiet=False):
 def deploy_repo(
     repo, destination, options, branch="master", allow_uninstall="clean"
 ):
-    """Create a checkout of the given `repo` and `branch` at `destination`
-    (relative to HOME), if `destination` does not exist yet.
-
-    If `destination` exists (and `options.uninstall` is False), do one of the
-    following:
-    * If `destination` is a git checkout, update it.
-    * If `destination` is not a git checkout, replace it with a checkout of
-      `repo` if `options.overwrite` is True, otherwise print a warning and exit
-
-    If `destination` exists, is a git checkout, and `options.uninstall` is
-    True, do one of the following:
-    * If `allow_uninstall` is 'clean', remove `destination` only if `git
-      status` does not show any uncommited changes (otherwise print an error
-      and exit)
-    * If `allow_uninstall` is 'dirty', remove `destination` unconditionally
-    * If `allow_uninstall` is 'no', do nothing
-    """
-    stdout = None
-    if options.quiet:
-        stdout = open(os.devnull, "w")
-    create_checkout = True
-    checkout_dir = os.path.join(HOME, destination)
-    if os.path.exists(checkout_dir):
-        create_checkout = False
-        if options.uninstall:
-            if os.path.exists(os.path.join(checkout_dir, ".git")):
-                if allow_uninstall == "dirty":
-                    shutil.rmtree(checkout_dir)
-                elif allow_uninstall == "clean":
-                    cmd = ["git", "status", "--porcelain"]
-                    status = check_output(cmd, cwd=checkout_dir)
-                    empty = status[0:0]  # `empty` of same type as `status`!
-                    if status.strip() == empty:
-                        shutil.rmtree(checkout_dir)
-                    else:
-                        print(
-                            "ERROR: Cannot uninstall %s (not clean)"
-                            % checkout_dir
-                        )
-                elif allow_uninstall == "no":
-                    pass
-                else:
-                    raise ValueError(
-                        "Invalid value %s for `allow_uninstall`"
-                        % allow_uninstall
-                    )
-            else:
-                print(
-                    "WARNING: %s cannnot be uninstalled (not a git repo)"
-                    % checkout_dir
-                )
-        else:  # update or overwrite
-            if os.path.exists(os.path.join(checkout_dir, ".git")):
-                git_update(checkout_dir, options.quiet)
-            else:
-                if options.overwrite:
-                    shutil.rmtree(checkout_dir)
-                    create_checkout = True
-                else:
-                    print(
-                        "WARNING: %s already exists and will not be "
-                        "overwritten without the --overwrite option"
-                        % checkout_dir
-                    )
-    if create_checkout:
-        if not check_remote_repo(repo, options.quiet):
-            return
-        cmd = ["git", "clone", repo, destination]
-        if not options.quiet:
-            print(" ".join(cmd))
-        ret = call(cmd, cwd=HOME, stderr=STDOUT, stdout=stdout)
-        if ret != 0:
-            if not options.quiet:
-                print("WARNING: git returned nonzero exist status (%s)")
-        cmd = ["git", "checkout", branch]
-        if not options.quiet:
-            print(" ".join(cmd))
-        ret = call(cmd, cwd=checkout_dir, stderr=STDOUT, stdout=stdout)
-        if ret != 0:
-            if not options.quiet:
-                print("WARNING: git returned nonzero exist status (%s)")
+    """Create or update a checkout of the given `repo` and `branch` at
+    `destination` (relative to HOME). See `Deployment.deploy_repo`"""
+    with _deployment(options) as deployment:
+        deployment.deploy_repo(repo, destination, branch, allow_uninstall)
 
 
 def mkdir(directory):
@@ -433,42 +1382,22 @@ def mkdir(directory):
         if head and not os.path.isdir(head):
             mkdir(head)
         if tail:
-            os.mkdir(directory)
+            try:
+                os.mkdir(directory)
+            except OSError as exc:
+                # another thread may have created the directory in the mean
+                # time
+                if exc.errno != errno.EEXIST or not os.path.isdir(
+                    directory
+                ):
+                    raise
 
 
 def get(url, destination, options, make_exec=False):
     """Download the file at the given URL to destination (relative to HOME).
-
-    If `make_exec` is True, also make it executable.
-
-    If the file already exists, an `OSError` will be raised, unless
-    `options.overwrite` is True.
-
-    If `options.uninstall` is True, destination will be deleted if it exists.
-    """
-    destination = os.path.join(HOME, destination)
-    mkdir(os.path.split(destination)[0])
-    if is_file_or_link(destination):
-        if options.overwrite or options.uninstall:
-            if options.uninstall and not options.quiet:
-                print("removing %s" % destination)
-            os.unlink(destination)
-            if options.uninstall:
-                return
-        else:
-            raise OSError("File %s already exists" % destination)
-    if os.path.isdir(destination):
-        raise OSError("%s is folder, must be file" % destination)
-    if not options.quiet:
-        print("%s -> %s" % (url, destination))
-    urlretrieve(url, destination)
-    if make_exec:
-        perms = os.stat(destination)
-        # chmod a+x
-        os.chmod(
-            destination,
-            perms.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
-        )
+    See `Deployment.get`"""
+    with _deployment(options) as deployment:
+        deployment.get(url, destination, make_exec)
 
 
 def git_update(folder=DOTFILES, quiet=False):
@@ -498,7 +1427,8 @@ def git_update(folder=DOTFILES, quiet=False):
 def run_duti(quiet=False, handlers="handlers.duti"):
     """Run the duti utility, which sets up handlers for opening files on MacOS
 
-    The path to the handlers file is relative to DOTFILES
+    The path to the handlers file is relative to DOTFILES, unless it is an
+    absolute path
     """
     duti = which("duti")
     if duti is not None:
@@ -530,6 +1460,252 @@ def set_crontab(quiet=False, crontab_file="~/.crontab"):
             raise OSError("crontab returned nonzero exist status (%s)" % ret)
 
 
+# Actions that can be used in a deploy spec: name -> (method of Deployment,
+# whether the action is network-bound)
+DEPLOY_ACTIONS = {
+    "make_links": (Deployment.make_links, False),
+    "deploy_vim": (Deployment.deploy_vim, True),
+    "deploy_neovim": (Deployment.deploy_neovim, True),
+    "deploy_repo": (Deployment.deploy_repo, True),
+    "get": (Deployment.get, True),
+    "run_duti": (Deployment.run_duti, False),
+    "set_crontab": (Deployment.set_crontab, False),
+}
+
+
+def load_deploy_spec(filename):
+    """Load a deploy spec from the given JSON or TOML file (relative to
+    DOTFILES, if not absolute). TOML requires Python >= 3.11 or the `tomli`
+    package."""
+    filename = os.path.join(DOTFILES, filename)
+    if filename.endswith(".toml"):
+        if tomllib is None:
+            raise ValueError(
+                "Reading %s requires Python >= 3.11 or tomli" % filename
+            )
+        with open(filename, "rb") as in_fh:
+            return tomllib.load(in_fh)
+    else:
+        with open(filename) as in_fh:
+            return json.load(in_fh)
+
+
+def deploy_steps(spec):
+    """Return the list of validated steps in the given deploy `spec`.
+
+    Every step is a dict with the keys 'name', 'action', 'requires', and
+    'args'. If missing in the spec, 'name' defaults to the action, 'requires'
+    to an empty list, and 'args' to an empty dict.
+
+    Raise ValueError if the spec is invalid, or if the dependencies between
+    the steps are circular.
+    """
+    steps = []
+    names = set()
+    for step in spec.get("steps", []):
+        if "action" not in step:
+            raise ValueError("Step %r has no action" % (step,))
+        if step["action"] not in DEPLOY_ACTIONS:
+            raise ValueError("Unknown action %r" % step["action"])
+        step = {
+            "name": step.get("name", step["action"]),
+            "action": step["action"],
+            "requires": list(step.get("requires", [])),
+            "args": dict(step.get("args", {})),
+        }
+        if step["name"] in names:
+            raise ValueError("Duplicate step name %r" % step["name"])
+        names.add(step["name"])
+        steps.append(step)
+    for step in steps:
+        for name in step["requires"]:
+            if name not in names:
+                raise ValueError(
+                    "Step %r requires unknown step %r" % (step["name"], name)
+                )
+    resolved = set()
+    unresolved = list(steps)
+    while unresolved:
+        ready = [
+            step
+            for step in unresolved
+            if all([name in resolved for name in step["requires"]])
+        ]
+        if len(ready) == 0:
+            raise ValueError(
+                "Circular dependencies between steps %s"
+                % ", ".join([step["name"] for step in unresolved])
+            )
+        for step in ready:
+            resolved.add(step["name"])
+            unresolved.remove(step)
+    return steps
+
+
+def run_deploy_spec(spec, options, processes=8):
+    """Run the steps of the given deploy `spec`, respecting the dependencies
+    between them. See `Deployment.run_spec`"""
+    with _deployment(options) as deployment:
+        deployment.run_spec(spec, processes)
+
+
+def percentile(values, q):
+    """Return the `q`-th percentile of the given values, interpolating
+    linearly between data points"""
+    if len(values) == 0:
+        raise ValueError("Cannot compute percentile of empty sequence")
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100.0
+    i = int(pos)
+    if i + 1 < len(values):
+        return values[i] + (values[i + 1] - values[i]) * (pos - i)
+    return values[i]
+
+
+def startup_time(cmd, env=None, timeout=BENCH_TIMEOUT):
+    """Run the command `cmd` (list of arguments) and return its startup time
+    in seconds.
+
+    In `cmd`, the placeholder {home} is replaced by the HOME in `env`. If
+    `cmd` contains the placeholder {startuptime}, it is replaced by the name
+    of a temporary file, and the time is read from the last line of that file
+    (in the format of the --startuptime option of vim/neovim, in
+    milliseconds). Otherwise, or if the tool does not write that file, return
+    the wall time of the command.
+
+    Raise an `OSError` if the command returns a nonzero exit status, or if it
+    does not finish within `timeout` seconds (in which case it is killed).
+    Timeouts are not available in Python 2.
+    """
+    if env is None:
+        env = os.environ
+    startuptime_file = None
+    if any(["{startuptime}" in arg for arg in cmd]):
+        fd, startuptime_file = tempfile.mkstemp(suffix=".startuptime")
+        os.close(fd)
+        os.unlink(startuptime_file)  # vim would append to it
+    cmd = [
+        arg.replace("{home}", env.get("HOME", HOME)).replace(
+            "{startuptime}", str(startuptime_file)
+        )
+        for arg in cmd
+    ]
+    devnull = open(os.devnull, "w+")
+    try:
+        start = timer()
+        proc = subprocess.Popen(
+            cmd, stdin=devnull, stdout=devnull, stderr=STDOUT, env=env
+        )
+        if TimeoutExpired is None:
+            ret = proc.wait()
+        else:
+            try:
+                ret = proc.wait(timeout=timeout)
+            except TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                raise OSError(
+                    "%s did not finish within %s seconds" % (cmd[0], timeout)
+                )
+        elapsed = timer() - start
+        if ret != 0:
+            raise OSError(
+                "%s returned nonzero exit status (%s)" % (cmd[0], ret)
+            )
+        if startuptime_file is not None:
+            lines = []
+            if os.path.isfile(startuptime_file):
+                with open(startuptime_file) as in_fh:
+                    lines = [line for line in in_fh if line.strip()]
+            try:
+                elapsed = float(lines[-1].split()[0]) / 1000.0
+            except (IndexError, ValueError):
+                pass  # no usable report: keep the wall time
+    finally:
+        devnull.close()
+        if startuptime_file is not None and os.path.isfile(startuptime_file):
+            os.unlink(startuptime_file)
+    return elapsed
+
+
+def _read_bench_history(baseline_file):
+    """Return the list of stored benchmark results in `baseline_file`"""
+    if os.path.isfile(baseline_file):
+        with open(baseline_file) as in_fh:
+            return json.load(in_fh)
+    return []
+
+
+def bench_baseline(commit, baseline_file):
+    """Return the benchmark results stored in the JSON file `baseline_file`
+    for the most recent commit of DOTFILES other than `commit` (the
+    baseline), or None if there are none"""
+    for entry in reversed(_read_bench_history(baseline_file)):
+        if entry["commit"] != commit:
+            return entry["results"]
+    return None
+
+
+def save_bench_results(results, commit, baseline_file):
+    """Store the benchmark `results` for the given `commit` of DOTFILES in the
+    JSON file `baseline_file`, replacing any earlier results for `commit`.
+
+    Only results without regressions should be stored, so that a slow commit
+    never becomes the baseline for later commits. The file keeps the results
+    for the 20 most recent commits.
+    """
+    history = [
+        entry
+        for entry in _read_bench_history(baseline_file)
+        if entry["commit"] != commit
+    ]
+    history.append({"commit": commit, "results": results})
+    with open(baseline_file, "w") as out_fh:
+        json.dump(history[-20:], out_fh, indent=2)
+
+
+def bench_regressions(results, baseline, threshold=BENCH_THRESHOLD):
+    """Return a sorted list of tools whose median startup time in `results`
+    exceeds the median in `baseline` by more than `threshold` seconds. Tools
+    without a startup time (an 'error') in either are ignored"""
+    if baseline is None:
+        return []
+    return sorted(
+        [
+            tool
+            for tool in results
+            if tool in baseline
+            and "median" in results[tool]
+            and "median" in baseline[tool]
+            and results[tool]["median"]
+            > baseline[tool]["median"] + threshold
+        ]
+    )
+
+
+def print_bench(results, baseline=None):
+    """Print a summary of the benchmark `results` returned by
+    `Deployment.bench`, compared to the `baseline`"""
+    print(
+        "%-8s %10s %10s %10s %10s"
+        % ("tool", "median", "p90", "max", "baseline")
+    )
+    for tool in sorted(results):
+        result = results[tool]
+        if "error" in result:
+            print("%-8s ERROR: %s" % (tool, result["error"]))
+            continue
+        line = "%-8s %7.1f ms %7.1f ms %7.1f ms" % (
+            tool,
+            1000 * result["median"],
+            1000 * result["p90"],
+            1000 * result["max"],
+        )
+        if baseline is not None and "median" in baseline.get(tool, {}):
+            line += " %7.1f ms" % (1000 * baseline[tool]["median"])
+        print(line)
+
+
 def get_options(argv=None):
     """Parse command line options. return options object"""
     if argv is None:
@@ -556,16 +1732,131 @@ def get_options(argv=None):
         default=False,
         help="Remove any existing links to dotfiles",
     )
-    return arg_parser.parse_args(argv)[0]
+    arg_parser.add_option(
+        "--conflict",
+        type="choice",
+        choices=list(CONFLICT_POLICIES),
+        dest="conflict",
+        default=None,
+        metavar="POLICY",
+        help="How to handle existing files that are in the way of deployed "
+        "files: 'backup' (move them into a single timestamped archive), "
+        "'skip', 'overwrite', or 'fail'. Takes precedence over --overwrite. "
+        "Without this option, ask for confirmation",
+    )
+    arg_parser.add_option(
+        "--verify",
+        action="store_true",
+        dest="verify",
+        default=False,
+        help="Report missing, broken, foreign, and stale links without "
+        "changing anything. Exit with nonzero status if there are any",
+    )
+    arg_parser.add_option(
+        "--bench",
+        action="store_true",
+        dest="bench",
+        default=False,
+        help="Measure the startup time of shells and editors with the "
+        "deployed configuration, and compare it to the last commit that "
+        "passed the benchmark. "
+        "Exit with nonzero status if it got slower",
+    )
+    arg_parser.add_option(
+        "--bench-runs",
+        type="int",
+        dest="bench_runs",
+        default=10,
+        metavar="N",
+        help="Number of runs for each tool with --bench (default: 10)",
+    )
+    options = arg_parser.parse_args(argv)[0]
+    if options.bench_runs < 1:
+        arg_parser.error("--bench-runs must be at least 1")
+    return options
 
 
 def main(deploy, argv=None):
-    """Main function, executing `deploy` routine"""
+    """Main function, executing `deploy` routine
+
+    The `deploy` routine is called with the parsed command line options, which
+    carry the Deployment for HOME and DOTFILES in their `deployment`
+    attribute. Instead of a routine, `deploy` may also be a deploy spec (a
+    dict, or the name of a JSON or TOML file relative to DOTFILES), which is
+    executed with `Deployment.run_spec`.
+
+    All operations of the deployment are recorded in the Journal
+    DOTFILES/.deploy.journal. If the previous deployment was interrupted, any
+    partial clone or download is rolled back, and the deployment resumes,
+    skipping the operations that were already completed.
+
+    With the --verify option, `deploy` is not called. Instead, the links in
+    the link logs are checked with `verify_links`, and the program exits with
+    a nonzero status if there are any problems.
+
+    With the --bench option, `deploy` is not called either. Instead, the
+    startup time of the tools in BENCH_COMMANDS is measured with
+    `Deployment.bench` for the configuration deployed in HOME, and compared
+    to the baseline: the results for the most recent other commit of
+    DOTFILES stored in DOTFILES/.bench.json. If any tool got slower or failed
+    to start, the program exits with a nonzero status. Otherwise, the results
+    are stored for the current commit of DOTFILES, and become the baseline
+    for later commits.
+    """
     options = get_options(argv)
+    deployment = Deployment(options=options)
+    options.deployment = deployment
     try:
-        git_update(folder=DOTFILES, quiet=options.quiet)
-        deploy(options)
+        if options.verify:
+            log_files = deployment.link_logs()
+            if len(log_files) == 0:
+                if not options.quiet:
+                    print("WARNING: no link logs found in %s" % DOTFILES)
+                sys.exit(1)
+            problems = deployment.verify_links(log_files)
+            if not options.quiet:
+                print_verification(problems)
+            if any(problems.values()):
+                sys.exit(1)
+        elif options.bench:
+            try:
+                cmd = ["git", "rev-parse", "HEAD"]
+                commit = check_output(cmd, cwd=DOTFILES).decode("utf-8")
+                commit = commit.strip()
+            except (OSError, subprocess.CalledProcessError):
+                commit = "unknown"
+            baseline_file = os.path.join(DOTFILES, ".bench.json")
+            results = deployment.bench(runs=options.bench_runs)
+            baseline = bench_baseline(commit, baseline_file)
+            regressions = bench_regressions(results, baseline)
+            errors = sorted(
+                [tool for tool in results if "error" in results[tool]]
+            )
+            if not options.quiet:
+                print_bench(results, baseline)
+                for tool in regressions:
+                    print("WARNING: %s starts slower than before" % tool)
+            if len(regressions) > 0 or len(errors) > 0:
+                sys.exit(1)
+            save_bench_results(results, commit, baseline_file)
+        else:
+            mode = "install"
+            if options.uninstall:
+                mode = "uninstall"
+            journal = Journal(os.path.join(DOTFILES, ".deploy.journal"), mode)
+            journal.recover(quiet=options.quiet)
+            if journal.resumed and not options.quiet:
+                print("Resuming interrupted deployment")
+            journal.open()
+            deployment.journal = journal
+            deployment.git_update()
+            if callable(deploy):
+                deploy(options)
+            else:
+                deployment.run_spec(deploy)
+            journal.close(completed=True)
     finally:
+        deployment.close()
         # self-destruct
         # We wouldn't want to accidentally edit this script in a a 'system'
         # branch
@@ -4,51 +4,67 @@ Tests for dotfiles.py
 Run with `py.test test_dotfiles.py`
 """
 import os
+import sys
 from os import readlink
 from os.path import join, isfile, isdir, islink, realpath
+import json
 import shutil
+import threading
+import time
+import subprocess
+import tarfile
 
 import pytest
 
 import dotfiles
 
+TEST_DOTFILES = join(os.path.dirname(os.path.abspath(__file__)), 'test',
+                     'DOTFILES')
+
 
 class DummyOptions(object):
-    def __init__(self, quiet=False, overwrite=False, uninstall=False):
+    def __init__(self, quiet=False, overwrite=False, uninstall=False,
+                 conflict=None):
         self.quiet = quiet
         self.overwrite = overwrite
         self.uninstall = uninstall
+        self.conflict = conflict
+
+
+def options_factory(home, dotfiles_dir=TEST_DOTFILES):
+    """Return a function that creates DummyOptions with a Deployment of
+    `dotfiles_dir` into `home` as their `deployment` attribute"""
+
+    def make_options(**kwargs):
+        options = DummyOptions(**kwargs)
+        options.deployment = dotfiles.Deployment(
+            home=home, dotfiles=dotfiles_dir, options=options,
+            config_home=join(home, '.config'))
+        return options
+
+    return make_options
 
 
 @pytest.fixture
-def test_home():
-    homedir = join("test", "HOME")
-    try:
-        shutil.rmtree(homedir)
-    except OSError:
-        pass
+def test_home(tmp_path):
+    homedir = str(tmp_path / "HOME")
     dotfiles.mkdir(homedir)
-    yield homedir
-    try:
-        shutil.rmtree(homedir)
-    except OSError:
-        pass
+    return homedir
 
 
 def test_make_link(test_home):
 
-    dotfiles.HOME = test_home
-    dotfiles.DOTFILES = join('test', 'DOTFILES')
+    options = options_factory(test_home)
 
     # create simple file
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions())
-    src_file = join(dotfiles.DOTFILES, '.bashrc')
-    target_file = join(dotfiles.HOME, '.bashrc')
+    dotfiles.make_link('.bashrc', '.bashrc', options())
+    src_file = join(TEST_DOTFILES, '.bashrc')
+    target_file = join(test_home, '.bashrc')
     assert isfile(target_file)
 
     # If the file exists and is linked correctly, making another link will do
     # nothing
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions())
+    dotfiles.make_link('.bashrc', '.bashrc', options())
     assert isfile(target_file)
 
     # if the file exists as a proper file, an error should be raised
@@ -56,7 +72,7 @@ def test_make_link(test_home):
     with open(target_file, 'w') as out_fh:
         out_fh.write("# .bashrc")
     try:
-        dotfiles.make_link('.bashrc', '.bashrc', DummyOptions(quiet=True))
+        dotfiles.make_link('.bashrc', '.bashrc', options(quiet=True))
         raise AssertionError("linking over existing proper file should fail")
     except OSError:
         pass
@@ -64,7 +80,7 @@ def test_make_link(test_home):
     # we may also confirm the overwrite interactively
     orig_input = dotfiles.input
     dotfiles.input = lambda query: 'yes'
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions(quiet=False))
+    dotfiles.make_link('.bashrc', '.bashrc', options(quiet=False))
     dotfiles.input = orig_input
     assert isfile(target_file)
 
@@ -72,7 +88,7 @@ def test_make_link(test_home):
     os.unlink(target_file)
     with open(target_file, 'w') as out_fh:
         out_fh.write("# .bashrc")
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions(overwrite=True))
+    dotfiles.make_link('.bashrc', '.bashrc', options(overwrite=True))
     assert isfile(target_file)
     assert (realpath(target_file) == realpath(src_file))
 
@@ -80,51 +96,51 @@ def test_make_link(test_home):
     os.unlink(target_file)
     dotfiles.mkdir(target_file)
     try:
-        dotfiles.make_link('.bashrc', '.bashrc', DummyOptions(overwrite=True))
+        dotfiles.make_link('.bashrc', '.bashrc', options(overwrite=True))
         raise AssertionError("overwriting existing folder should fail")
     except OSError:
         pass
     shutil.rmtree(target_file)
 
     # The uninstall option should remove the file
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions())
+    dotfiles.make_link('.bashrc', '.bashrc', options())
     assert isfile(target_file)
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions(uninstall=True))
+    dotfiles.make_link('.bashrc', '.bashrc', options(uninstall=True))
     assert not isfile(target_file)
 
     # but only if the file is actually linked correctly
-    dotfiles.mkdir(dotfiles.HOME)
+    dotfiles.mkdir(test_home)
     with open(target_file, 'w') as out_fh:
         out_fh.write("# .bashrc")
     assert isfile(target_file)
-    dotfiles.make_link('.bashrc', '.bashrc', DummyOptions(uninstall=True))
+    dotfiles.make_link('.bashrc', '.bashrc', options(uninstall=True))
     assert isfile(target_file)
 
 
 def test_get(test_home):
 
-    dotfiles.HOME = test_home
+    options = options_factory(test_home)
 
     # Standard download
     url = 'https://raw.githubusercontent.com/goerz/dotfiles/master/'\
           'README.markdown'
-    target_file = join('test', 'HOME', 'README')
-    dotfiles.get(url, 'README', DummyOptions(), make_exec=False)
+    target_file = join(test_home, 'README')
+    dotfiles.get(url, 'README', options(), make_exec=False)
     assert isfile(target_file)
 
     # Should fail if file already exists
     try:
-        dotfiles.get(url, 'README', DummyOptions(), make_exec=False)
+        dotfiles.get(url, 'README', options(), make_exec=False)
         raise AssertionError("downloading over existing file should fail")
     except OSError:
         pass
 
     # Unless overwrite is True
-    dotfiles.get(url, 'README', DummyOptions(overwrite=True))
+    dotfiles.get(url, 'README', options(overwrite=True))
     assert isfile(target_file) and not os.access(target_file, os.X_OK)
 
     # If make_exec is True, the resulting file should be executable
-    dotfiles.get(url, 'README', DummyOptions(overwrite=True), make_exec=True)
+    dotfiles.get(url, 'README', options(overwrite=True), make_exec=True)
     assert isfile(target_file) and os.access(target_file, os.X_OK)
 
 
@@ -136,107 +152,683 @@ def test_check_remote_repo():
 
 def test_deploy_repo(test_home):
     """Test deployment of a git repo"""
-    dotfiles.HOME = test_home
-    dotfiles.DOTFILES = join('test', 'DOTFILES')
-    dotfiles.mkdir(dotfiles.HOME)
+    options = options_factory(test_home)
+    dotfiles.mkdir(test_home)
     # checkout (failing)
-    dotfiles.mkdir(os.path.join(dotfiles.HOME, 'myvimdir'))
+    dotfiles.mkdir(os.path.join(test_home, 'myvimdir'))
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions())
-    assert isdir(join(dotfiles.HOME, 'myvimdir'))
-    assert not isfile(join(dotfiles.HOME, 'myvimdir', 'init.vim'))
+                         options())
+    assert isdir(join(test_home, 'myvimdir'))
+    assert not isfile(join(test_home, 'myvimdir', 'init.vim'))
     # overwrite checkout
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions(overwrite=True))
-    assert isdir(join(dotfiles.HOME, 'myvimdir'))
-    assert isfile(join(dotfiles.HOME, 'myvimdir', 'init.vim'))
+                         options(overwrite=True))
+    assert isdir(join(test_home, 'myvimdir'))
+    assert isfile(join(test_home, 'myvimdir', 'init.vim'))
     # refresh
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions(), allow_uninstall='clean')
+                         options(), allow_uninstall='clean')
     # clean uninstall
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions(uninstall=True))
-    assert not isfile(join(dotfiles.HOME, 'myvimdir', 'init.vim'))
-    assert not isdir(join(dotfiles.HOME, 'myvimdir'))
+                         options(uninstall=True))
+    assert not isfile(join(test_home, 'myvimdir', 'init.vim'))
+    assert not isdir(join(test_home, 'myvimdir'))
     # new checkout
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions())
-    with open(os.path.join(dotfiles.HOME, 'myvimdir', 'new_file.txt'), 'w') \
+                         options())
+    with open(os.path.join(test_home, 'myvimdir', 'new_file.txt'), 'w') \
             as out_fh:
         out_fh.write("Hello World")
-    assert isdir(join(dotfiles.HOME, 'myvimdir'))
-    assert isfile(join(dotfiles.HOME, 'myvimdir', 'init.vim'))
-    assert isfile(join(dotfiles.HOME, 'myvimdir', 'new_file.txt'))
+    assert isdir(join(test_home, 'myvimdir'))
+    assert isfile(join(test_home, 'myvimdir', 'init.vim'))
+    assert isfile(join(test_home, 'myvimdir', 'new_file.txt'))
     # clean uninstall (failing)
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions(uninstall=True), allow_uninstall='clean')
-    assert isfile(join(dotfiles.HOME, 'myvimdir', 'new_file.txt'))
+                         options(uninstall=True), allow_uninstall='clean')
+    assert isfile(join(test_home, 'myvimdir', 'new_file.txt'))
     # dirty uninstall
     dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
-                         DummyOptions(uninstall=True), allow_uninstall='dirty')
-    assert not isdir(join(dotfiles.HOME, 'myvimdir'))
+                         options(uninstall=True), allow_uninstall='dirty')
+    assert not isdir(join(test_home, 'myvimdir'))
 
 
 def test_deploy_vim(test_home, monkeypatch):
     """Test vim deployment"""
 
-    dotfiles.HOME = test_home
-    dotfiles.DOTFILES = join('test', 'DOTFILES')
-    monkeypatch.delenv('XDG_CONFIG_HOME', raising=False)
-
-    dotfiles.mkdir(dotfiles.HOME)
-    dotfiles.deploy_vim('https://github.com/goerz/vimrc.git', DummyOptions())
-    assert islink(join(dotfiles.HOME, '.vimrc'))
-    assert isdir(join(dotfiles.HOME, '.vim'))
-    assert isfile(join(dotfiles.HOME, '.vim', 'init.vim'))
-    assert islink(join(dotfiles.HOME, '.config', 'nvim'))
-    assert isfile(join(dotfiles.HOME, '.config', 'nvim', 'init.vim'))
+    options = options_factory(test_home)
+
+    dotfiles.mkdir(test_home)
+    dotfiles.deploy_vim('https://github.com/goerz/vimrc.git', options())
+    assert islink(join(test_home, '.vimrc'))
+    assert isdir(join(test_home, '.vim'))
+    assert isfile(join(test_home, '.vim', 'init.vim'))
+    assert islink(join(test_home, '.config', 'nvim'))
+    assert isfile(join(test_home, '.config', 'nvim', 'init.vim'))
     # A second call should update the repository
-    dotfiles.deploy_vim('https://github.com/goerz/vimrc.git', DummyOptions())
+    dotfiles.deploy_vim('https://github.com/goerz/vimrc.git', options())
     # uninstall
     dotfiles.deploy_vim('https://github.com/goerz/vimrc.git',
-                        DummyOptions(uninstall=True))
-    assert not isfile(join(dotfiles.HOME, '.vimrc'))
-    assert not islink(join(dotfiles.HOME, '.config', 'nvim'))
-    assert not isfile(join(dotfiles.HOME, '.config', 'nvim', 'init.vim'))
+                        options(uninstall=True))
+    assert not isfile(join(test_home, '.vimrc'))
+    assert not islink(join(test_home, '.config', 'nvim'))
+    assert not isfile(join(test_home, '.config', 'nvim', 'init.vim'))
 
 
 def test_make_links(test_home):
 
-    dotfiles.HOME = test_home
-    shutil.copytree(join('test', 'DOTFILES'),
-                    join(dotfiles.HOME, '.dotfiles', 'HOME'))
-    dotfiles.DOTFILES = join(dotfiles.HOME, '.dotfiles')
+    dotfiles_dir = join(test_home, '.dotfiles')
+    shutil.copytree(TEST_DOTFILES, join(dotfiles_dir, 'HOME'))
+    options = options_factory(test_home, dotfiles_dir)
 
-    dotfiles.make_links('HOME', DummyOptions())
+    dotfiles.make_links('HOME', options())
 
     def check_link(link_file, dest):
-        assert readlink(os.sep.join(link_file.split("/"))) \
+        assert readlink(join(test_home, *link_file.split("/"))) \
                 == os.sep.join(dest.split("/"))
 
-    check_link('test/HOME/bin/ack', '../.dotfiles/HOME/bin/ack')
-    assert os.access(join(dotfiles.HOME, 'bin', 'ack'), os.X_OK)
-    check_link('test/HOME/.bashrc', '.dotfiles/HOME/.bashrc')
-    check_link('test/HOME/.grace/gracerc.user',
+    check_link('bin/ack', '../.dotfiles/HOME/bin/ack')
+    assert os.access(join(test_home, 'bin', 'ack'), os.X_OK)
+    check_link('.bashrc', '.dotfiles/HOME/.bashrc')
+    check_link('.grace/gracerc.user',
                '../.dotfiles/HOME/.grace/gracerc.user')
-    check_link('test/HOME/.grace/templates/Default.agr',
+    check_link('.grace/templates/Default.agr',
                '../../.dotfiles/HOME/.grace/templates/Default.agr')
-    check_link('test/HOME/.config/Terminal/terminalrc',
+    check_link('.config/Terminal/terminalrc',
                '../../.dotfiles/HOME/.config/Terminal/terminalrc')
 
     # Running make_links again should not change anything
-    dotfiles.make_links('HOME', DummyOptions())
+    dotfiles.make_links('HOME', options())
 
-    check_link('test/HOME/.bashrc', '.dotfiles/HOME/.bashrc')
-    check_link('test/HOME/.grace/gracerc.user',
+    check_link('.bashrc', '.dotfiles/HOME/.bashrc')
+    check_link('.grace/gracerc.user',
                '../.dotfiles/HOME/.grace/gracerc.user')
-    check_link('test/HOME/.grace/templates/Default.agr',
+    check_link('.grace/templates/Default.agr',
                '../../.dotfiles/HOME/.grace/templates/Default.agr')
-    check_link('test/HOME/.config/Terminal/terminalrc',
+    check_link('.config/Terminal/terminalrc',
                '../../.dotfiles/HOME/.config/Terminal/terminalrc')
 
     # uninstall should remove all linked files and empty folders
-    dotfiles.make_links('HOME', DummyOptions(uninstall=True))
-    assert isdir(dotfiles.DOTFILES)
-    assert not isfile(join(dotfiles.HOME, '.bashrc'))
-    assert not isdir(join(dotfiles.HOME, '.grace'))
+    dotfiles.make_links('HOME', options(uninstall=True))
+    assert isdir(dotfiles_dir)
+    assert not isfile(join(test_home, '.bashrc'))
+    assert not isdir(join(test_home, '.grace'))
+
+
+def test_verify_links(test_home):
+
+    dotfiles_dir = join(test_home, '.dotfiles')
+    shutil.copytree(TEST_DOTFILES, join(dotfiles_dir, 'HOME'))
+    options = options_factory(test_home, dotfiles_dir)
+
+    deployment = options(quiet=True).deployment
+    deployment.make_links('HOME')
+    assert deployment.link_logs() == [join(dotfiles_dir, '.HOME.links')]
+    problems = deployment.verify_links()
+    assert not any(problems.values())
+
+    bashrc = os.path.abspath(join(test_home, '.bashrc'))
+    tmux_conf = os.path.abspath(join(test_home, '.tmux.conf'))
+    terminalrc = os.path.abspath(
+        join(test_home, '.config', 'Terminal', 'terminalrc'))
+    ack = os.path.abspath(join(test_home, 'bin', 'ack'))
+    os.unlink(bashrc)
+    os.unlink(tmux_conf)
+    with open(tmux_conf, 'w') as out_fh:
+        out_fh.write("# .tmux.conf")
+    os.unlink(join(dotfiles_dir, 'HOME', '.config', 'Terminal',
+                   'terminalrc'))
+    problems = deployment.verify_links()
+    assert problems == {'missing': [bashrc], 'broken': [terminalrc],
+                        'foreign': [tmux_conf], 'stale': []}
+
+    # After removing a file from DOTFILES and re-deploying, the link is no
+    # longer logged, but is left behind
+    os.unlink(tmux_conf)
+    os.unlink(join(dotfiles_dir, 'HOME', 'bin', 'ack'))
+    deployment.make_links('HOME')
+    problems = deployment.verify_links()
+    assert problems == {'missing': [], 'broken': [],
+                        'foreign': [], 'stale': [terminalrc, ack]}
+
+
+def test_make_links_use_git(test_home):
+
+    dotfiles_dir = join(test_home, '.dotfiles')
+    shutil.copytree(TEST_DOTFILES, join(dotfiles_dir, 'HOME'))
+    options = options_factory(test_home, dotfiles_dir)
+    subprocess.check_call(['git', 'init', '-q'], cwd=dotfiles_dir)
+    subprocess.check_call(['git', 'add', 'HOME'], cwd=dotfiles_dir)
+    # untracked files
+    with open(join(dotfiles_dir, 'HOME', '.bashrc.swp'), 'w') as out_fh:
+        out_fh.write("swap")
+    dotfiles.mkdir(join(dotfiles_dir, 'HOME', 'build'))
+    with open(join(dotfiles_dir, 'HOME', 'build', 'a.o'), 'w') as out_fh:
+        out_fh.write("object")
+
+    files = dict((path, mode) for (mode, path)
+                 in options().deployment.git_files('HOME'))
+    assert files[join('HOME', 'bin', 'ack')] == '100755'
+    assert files[join('HOME', '.bashrc')] == '100644'
+    assert join('HOME', '.bashrc.swp') not in files
+
+    dotfiles.make_links('HOME', options(), use_git=True)
+    assert readlink(join(test_home, 'bin', 'ack')) \
+        == join('..', '.dotfiles', 'HOME', 'bin', 'ack')
+    assert os.access(join(test_home, 'bin', 'ack'), os.X_OK)
+    assert readlink(join(test_home, '.config', 'Terminal',
+                         'terminalrc')) \
+        == join('..', '..', '.dotfiles', 'HOME', '.config', 'Terminal',
+                'terminalrc')
+    assert islink(join(test_home, '.bashrc'))
+    assert not os.path.lexists(join(test_home, '.bashrc.swp'))
+    assert not os.path.lexists(join(test_home, 'build'))
+    assert not any(options().deployment.verify_links().values())
+
+    # tracked files missing from the working tree are not linked
+    os.unlink(join(dotfiles_dir, 'HOME', '.tmux.conf'))
+    os.unlink(join(test_home, '.tmux.conf'))
+    dotfiles.make_links('HOME', options(quiet=True), use_git=True)
+    assert not os.path.lexists(join(test_home, '.tmux.conf'))
+    assert not any(options().deployment.verify_links().values())
+
+    # non-recursive
+    dotfiles.make_links('HOME', options(uninstall=True), use_git=True)
+    assert not isdir(join(test_home, '.grace'))
+    dotfiles.make_links('HOME', options(), recursive=False, use_git=True)
+    assert islink(join(test_home, '.bashrc'))
+    assert not isdir(join(test_home, '.grace'))
+
+    # files tracked in a submodule are linked, untracked files are not
+    vim_repo = join(os.path.dirname(test_home), 'vimrc')
+    dotfiles.mkdir(vim_repo)
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+           '-c', 'protocol.file.allow=always']
+    subprocess.check_call(git + ['init', '-q'], cwd=vim_repo)
+    with open(join(vim_repo, 'init.vim'), 'w') as out_fh:
+        out_fh.write("set nocompatible\n")
+    subprocess.check_call(git + ['add', 'init.vim'], cwd=vim_repo)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'init'], cwd=vim_repo)
+    subprocess.check_call(git + ['submodule', '-q', 'add', vim_repo,
+                                 join('HOME', '.vim')], cwd=dotfiles_dir)
+    with open(join(dotfiles_dir, 'HOME', '.vim', 'junk.swp'), 'w') as out_fh:
+        out_fh.write("swap")
+    files = dict((path, mode) for (mode, path)
+                 in options().deployment.git_files('HOME'))
+    assert files[join('HOME', '.vim', 'init.vim')] == '100644'
+    dotfiles.make_links('HOME', options(), use_git=True)
+    assert readlink(join(test_home, '.vim', 'init.vim')) \
+        == join('..', '.dotfiles', 'HOME', '.vim', 'init.vim')
+    assert not os.path.lexists(join(test_home, '.vim', 'junk.swp'))
+    assert not os.path.lexists(join(test_home, '.vim', '.git'))
+    assert not any(options().deployment.verify_links().values())
+
+
+def test_run_deploy_spec(test_home, monkeypatch):
+    """Test running a declarative deploy spec"""
+
+    dotfiles_dir = join(test_home, '.dotfiles')
+    shutil.copytree(TEST_DOTFILES, join(dotfiles_dir, 'HOME'))
+    options = options_factory(test_home, dotfiles_dir)
+
+    log = []
+    started = dict((name, threading.Event()) for name in ['clone1', 'clone2'])
+
+    def clone(deployment, name, other):
+        # only succeeds if both clones run in parallel
+        started[name].set()
+        log.append((name, started[other].wait(5)))
+
+    def fail(deployment):
+        raise OSError("failed")
+
+    def record(deployment, name):
+        log.append((name, deployment.options.quiet))
+
+    monkeypatch.setitem(dotfiles.DEPLOY_ACTIONS, 'clone', (clone, True))
+    monkeypatch.setitem(dotfiles.DEPLOY_ACTIONS, 'fail', (fail, False))
+    monkeypatch.setitem(dotfiles.DEPLOY_ACTIONS, 'record', (record, False))
+    spec = {'steps': [
+        {'name': 'links', 'action': 'make_links', 'args': {'folder': 'HOME'},
+         'requires': ['clone1', 'clone2']},
+        {'name': 'after_links', 'action': 'record',
+         'args': {'name': 'after_links'}, 'requires': ['links']},
+        {'name': 'clone1', 'action': 'clone',
+         'args': {'name': 'clone1', 'other': 'clone2'}},
+        {'name': 'clone2', 'action': 'clone',
+         'args': {'name': 'clone2', 'other': 'clone1'}},
+    ]}
+    with open(join(dotfiles_dir, 'deploy.json'), 'w') as out_fh:
+        json.dump(spec, out_fh)
+    dotfiles.run_deploy_spec('deploy.json', options(quiet=True))
+    assert sorted(log[:2]) == [('clone1', True), ('clone2', True)]
+    assert log[2:] == [('after_links', True)]
+    assert islink(join(test_home, '.bashrc'))
+
+    # a failing step skips everything depending on it
+    del log[:]
+    spec['steps'][0] = {'name': 'links', 'action': 'fail'}
+    with pytest.raises(OSError):
+        dotfiles.run_deploy_spec(spec, options(quiet=True))
+    assert sorted(log) == [('clone1', True), ('clone2', True)]
+
+    # invalid specs
+    spec['steps'][0]['requires'] = ['after_links']
+    with pytest.raises(ValueError):
+        dotfiles.run_deploy_spec(spec, options(quiet=True))
+    with pytest.raises(ValueError):
+        dotfiles.deploy_steps({'steps': [{'action': 'unknown'}]})
+    with pytest.raises(ValueError):
+        dotfiles.deploy_steps({'steps': [{'action': 'record',
+                                          'requires': ['unknown']}]})
+
+
+def test_run_deploy_spec_fs_lock(test_home, monkeypatch):
+    """Test that network steps and make_links do not change `home` at the
+    same time"""
+
+    dotfiles_dir = join(test_home, '.dotfiles')
+    shutil.copytree(TEST_DOTFILES, join(dotfiles_dir, 'HOME'))
+    options = options_factory(test_home, dotfiles_dir)
+    vim_repo = os.path.abspath(join(test_home, 'vimrc.git'))
+    dotfiles.mkdir(vim_repo)
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    subprocess.check_call(git + ['init', '-q'], cwd=vim_repo)
+    subprocess.check_call(git + ['symbolic-ref', 'HEAD', 'refs/heads/master'],
+                          cwd=vim_repo)
+    with open(join(vim_repo, 'init.vim'), 'w') as out_fh:
+        out_fh.write("set nocompatible\n")
+    subprocess.check_call(git + ['add', 'init.vim'], cwd=vim_repo)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'init'], cwd=vim_repo)
+
+    make_link = dotfiles.Deployment.make_link
+    active = []
+    max_active = []
+
+    def tracked_make_link(deployment, src, dst):
+        active.append(dst)
+        max_active.append(len(active))
+        time.sleep(0.01)
+        try:
+            return make_link(deployment, src, dst)
+        finally:
+            active.remove(dst)
+
+    monkeypatch.setattr(dotfiles.Deployment, 'make_link', tracked_make_link)
+    spec = {'steps': [
+        {'action': 'deploy_vim', 'args': {'repo': vim_repo}},
+        {'action': 'make_links', 'args': {'folder': 'HOME'}},
+    ]}
+    dotfiles.run_deploy_spec(spec, options(quiet=True))
+    assert islink(join(test_home, '.vimrc'))
+    assert islink(join(test_home, '.bashrc'))
+    assert max(max_active) == 1
+
+
+def test_journal(test_home, monkeypatch):
+    """Test resuming an interrupted deployment from the journal"""
+
+    options = options_factory(test_home)
+    journal_file = join(test_home, '.deploy.journal')
+    partial_clone = os.path.abspath(join(test_home, 'myvimdir'))
+    partial_download = os.path.abspath(join(test_home, 'bin', 'tool'))
+    bashrc = os.path.abspath(join(test_home, '.bashrc'))
+    tmux_conf = os.path.abspath(join(test_home, '.tmux.conf'))
+    dotfiles.mkdir(join(partial_clone, '.git'))
+    dotfiles.mkdir(join(test_home, 'bin'))
+    with open(partial_download + '.part', 'w') as out_fh:
+        out_fh.write("partial")
+    with open(journal_file, 'w') as out_fh:
+        out_fh.write("start\tinstall\n")
+        out_fh.write("done\tlink\t%s\n" % bashrc)
+        out_fh.write("begin\tclone\t%s\n" % partial_clone)
+        out_fh.write("begin\tget\t%s\n" % partial_download)
+        out_fh.write("don")  # crashed while writing
+
+    # an uninstall does not resume the interrupted install ...
+    journal = dotfiles.Journal(journal_file, mode='uninstall')
+    assert not journal.resumed
+    assert not journal.is_done('link', bashrc)
+
+    # ... but an install does
+    journal = dotfiles.Journal(journal_file)
+    assert journal.resumed
+    assert journal.is_done('link', bashrc)
+    assert not journal.is_done('clone', partial_clone)
+    journal.recover(quiet=True)
+    assert not isdir(partial_clone)
+    assert not isfile(partial_download + '.part')
+
+    journal.open()
+    deployment = options().deployment
+    deployment.journal = journal
+    deployment.make_link('.bashrc', '.bashrc')
+    deployment.make_link('.tmux.conf', '.tmux.conf')
+    assert not islink(bashrc)  # skipped
+    assert islink(tmux_conf)
+    deployment.close()
+    with open(journal_file) as in_fh:
+        assert in_fh.read().splitlines()[4:6] == ['don', 'start\tinstall']
+
+    # after the interruption, the next run resumes again
+    journal = dotfiles.Journal(journal_file)
+    assert journal.resumed
+    assert journal.is_done('link', bashrc)
+    assert journal.is_done('link', tmux_conf)
+    journal.open()
+    journal.close(completed=True)
+
+    # after a completed deployment, nothing is resumed
+    journal = dotfiles.Journal(journal_file)
+    assert not journal.resumed
+    assert not journal.is_done('link', tmux_conf)
+
+    # two interruptions in a row
+    journal = dotfiles.Journal(journal_file)
+    journal.open()
+    journal.done('link', bashrc)
+    journal.close()
+    journal = dotfiles.Journal(journal_file)
+    assert journal.resumed
+    journal.open()
+    journal.done('link', tmux_conf)
+    journal.close()
+    journal = dotfiles.Journal(journal_file)
+    assert journal.resumed
+    assert journal.is_done('link', bashrc)
+    assert journal.is_done('link', tmux_conf)
+    journal.open()
+    journal.close(completed=True)
+
+    # a clone that is not completed in a finished deployment is kept
+    with open(journal_file, 'w') as out_fh:
+        out_fh.write("start\tinstall\n")
+        out_fh.write("begin\tclone\t%s\n" % partial_clone)
+        out_fh.write("end\n")
+    dotfiles.mkdir(join(partial_clone, '.git'))
+    journal = dotfiles.Journal(journal_file)
+    journal.recover(quiet=True)
+    assert isdir(partial_clone)
+
+    # a complete clone is recorded as done, even if the checkout fails
+    repo = os.path.abspath(join(test_home, 'repo.git'))
+    dotfiles.mkdir(repo)
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    subprocess.check_call(git + ['init', '-q'], cwd=repo)
+    subprocess.check_call(git + ['symbolic-ref', 'HEAD', 'refs/heads/main'],
+                          cwd=repo)
+    subprocess.check_call(git + ['commit', '-q', '--allow-empty', '-m', 'i'],
+                          cwd=repo)
+    journal = dotfiles.Journal(journal_file)
+    journal.open()
+    deployment = options(quiet=True).deployment
+    deployment.journal = journal
+    deployment.deploy_repo(repo, 'checkout')
+    with open(join(test_home, 'afile'), 'w') as out_fh:
+        out_fh.write("not a folder")
+    deployment.deploy_repo(repo, join('afile', 'checkout'))  # clone fails
+    deployment.close()
+    checkout = os.path.abspath(join(test_home, 'checkout'))
+    journal = dotfiles.Journal(journal_file)
+    assert journal.is_done('clone', checkout)
+    assert not journal.is_done('deploy_repo', checkout)
+    failed = os.path.abspath(join(test_home, 'afile', 'checkout'))
+    assert not journal.is_done('clone', failed)
+    assert not journal.is_done('deploy_repo', failed)
+    journal.recover(quiet=True)
+    assert isdir(join(checkout, '.git'))
+
+    # deploy spec steps are journaled by their name, not as paths
+    log = []
+    monkeypatch.setitem(dotfiles.DEPLOY_ACTIONS, 'record',
+                        (lambda deployment, name: log.append(name), False))
+
+    def spec(*names):
+        return {'steps': [{'name': name, 'action': 'record',
+                           'args': {'name': name}} for name in names]}
+
+    journal = dotfiles.Journal(journal_file)
+    journal.open()
+    deployment = options(quiet=True).deployment
+    deployment.journal = journal
+    deployment.run_spec(spec('b', 'crontab'))
+    deployment.close()
+    with open(journal_file) as in_fh:
+        assert "done\tstep\tcrontab\n" in in_fh.read()
+    monkeypatch.chdir(join(test_home, 'checkout'))
+    journal = dotfiles.Journal(journal_file)
+    journal.open()
+    deployment = options(quiet=True).deployment
+    deployment.journal = journal
+    deployment.run_spec(spec('b', 'crontab', 'a/../b'))
+    deployment.close()
+    assert sorted(log[:2]) == ['b', 'crontab']
+    assert log[2:] == ['a/../b']
+
+
+def test_conflict_policies(test_home, monkeypatch):
+    """Test non-interactive resolution of conflicts with existing files"""
+
+    options = options_factory(test_home)
+    bashrc = join(test_home, '.bashrc')
+    terminal = join(test_home, '.config', 'Terminal')
+    terminalrc = join('.config', 'Terminal', 'terminalrc')
+
+    def write_file(filename):
+        dotfiles.mkdir(os.path.split(filename)[0])
+        with open(filename, 'w') as out_fh:
+            out_fh.write("# %s" % filename)
+
+    write_file(bashrc)
+    write_file(terminal)
+
+    # 'fail' raises and leaves everything in place
+    with pytest.raises(OSError):
+        dotfiles.make_link('.bashrc', '.bashrc',
+                           options(quiet=True, conflict='fail'))
+    with pytest.raises(OSError):
+        dotfiles.make_link(terminalrc, terminalrc,
+                           options(quiet=True, conflict='fail'))
+    assert isfile(bashrc) and not islink(bashrc)
+
+    # 'skip' does nothing
+    dotfiles.make_link('.bashrc', '.bashrc',
+                       options(quiet=True, conflict='skip'))
+    dotfiles.make_link(terminalrc, terminalrc,
+                       options(quiet=True, conflict='skip'))
+    assert isfile(bashrc) and not islink(bashrc)
+    assert isfile(terminal)
+
+    # 'backup' collects all displaced files in a single archive
+    deployment = options(quiet=True, conflict='backup').deployment
+    deployment.make_link('.bashrc', '.bashrc')
+    deployment.make_link(terminalrc, terminalrc)
+    assert islink(bashrc)
+    assert islink(join(test_home, terminalrc))
+    assert deployment.counts['backups'] == 2
+    archive = deployment.backup.archive
+    staging_folder = deployment.backup.folder
+    deployment.close()
+    assert deployment.backup is None
+    assert isfile(archive)
+    assert not isdir(staging_folder)
+    with tarfile.open(archive) as tar:
+        assert sorted(tar.getnames()) == ['.bashrc', '.config/Terminal']
+        assert tar.extractfile('.bashrc').read().startswith(b'# ')
+
+    # 'overwrite' removes the existing file
+    os.unlink(bashrc)
+    write_file(bashrc)
+    dotfiles.make_link('.bashrc', '.bashrc',
+                       options(quiet=True, conflict='overwrite'))
+    assert islink(bashrc)
+
+    # without --conflict, --overwrite still asks before replacing a parent
+    # folder that is a file
+    shutil.rmtree(terminal)
+    write_file(terminal)
+    monkeypatch.setattr(dotfiles, 'input', lambda query: 'no')
+    with pytest.raises(OSError):
+        dotfiles.make_link(terminalrc, terminalrc, options(overwrite=True))
+    assert isfile(terminal)
+    monkeypatch.setattr(dotfiles, 'input', lambda query: 'yes')
+    dotfiles.make_link(terminalrc, terminalrc, options(overwrite=True))
+    assert islink(join(test_home, terminalrc))
+
+    # get and deploy_repo (no network access required for these)
+    write_file(join(test_home, 'README'))
+    dotfiles.get('http://example.com/README', 'README',
+                 options(quiet=True, conflict='skip'))
+    with pytest.raises(OSError):
+        dotfiles.get('http://example.com/README', 'README',
+                     options(quiet=True, conflict='fail'))
+    dotfiles.mkdir(join(test_home, 'myvimdir'))
+    dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
+                         options(quiet=True, conflict='skip'))
+    with pytest.raises(OSError):
+        dotfiles.deploy_repo('https://github.com/goerz/vimrc.git', 'myvimdir',
+                             options(quiet=True, conflict='fail'))
+    assert isdir(join(test_home, 'myvimdir'))
+
+
+def test_concurrent_deployments(test_home):
+    """Test independent deployments running in parallel threads"""
+
+    dotfiles.mkdir(join(test_home, 'DOTFILES'))
+    homes = []
+    deployments = []
+    for i in range(4):
+        dotfiles_dir = join(test_home, 'DOTFILES', str(i))
+        shutil.copytree(TEST_DOTFILES, join(dotfiles_dir, 'HOME'))
+        home = join(test_home, 'HOME%d' % i)
+        dotfiles.mkdir(home)
+        homes.append(home)
+        deployments.append(dotfiles.Deployment(
+            home=home, dotfiles=dotfiles_dir,
+            options=DummyOptions(quiet=True)))
+
+    threads = [threading.Thread(target=deployment.make_links, args=('HOME',))
+               for deployment in deployments]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i, (home, deployment) in enumerate(zip(homes, deployments)):
+        assert deployment.counts['links'] == 6
+        assert realpath(join(home, '.bashrc')) == realpath(
+            join(test_home, 'DOTFILES', str(i), 'HOME', '.bashrc'))
+        assert not any(deployment.verify_links().values())
+
+
+def test_run_duti_set_crontab(test_home, monkeypatch):
+    """Test that duti and crontab get the files of the deployment"""
+
+    calls = []
+    monkeypatch.setattr(dotfiles, 'which', lambda program: program)
+    monkeypatch.setattr(dotfiles, 'call', lambda cmd: calls.append(cmd) or 0)
+    monkeypatch.chdir(test_home)
+    deployment = dotfiles.Deployment(home='HOME', dotfiles='DOTFILES',
+                                     options=DummyOptions(quiet=True))
+    deployment.run_duti()
+    deployment.set_crontab()
+    assert calls == [
+        ['duti', join(test_home, 'DOTFILES', 'handlers.duti')],
+        ['crontab', '-r'],
+    ]
+    dotfiles.mkdir('HOME')
+    with open(join('HOME', '.crontab'), 'w') as out_fh:
+        out_fh.write("\n")
+    deployment.set_crontab()
+    assert calls[-1] == ['crontab', join(test_home, 'HOME', '.crontab')]
+
+
+def test_bench(test_home):
+    """Test benchmarking the startup time of tools"""
+
+    deployment = options_factory(test_home)(quiet=True).deployment
+    report = ("000.010  000.010: --- start ---\n"
+              "012.500  000.100: --- NVIM STARTED ---\n")
+    commands = {
+        'python': [sys.executable, '-c',
+                   'import sys; open(sys.argv[1], "w").close()',
+                   '{home}/ran'],
+        'startuptime': [sys.executable, '-c',
+                        'import sys; open(sys.argv[1], "w").write(%r)'
+                        % report, '{startuptime}'],
+        'noreport': [sys.executable, '-c', 'pass', '{startuptime}'],
+        'failing': [sys.executable, '-c', 'import sys; sys.exit(1)'],
+        'missing': ['dotfiles-no-such-program'],
+    }
+    results = deployment.bench(commands, runs=3)
+    assert sorted(results) == ['failing', 'noreport', 'python',
+                               'startuptime']
+    assert 'returned nonzero exit status' in results['failing']['error']
+    assert results['noreport']['median'] > 0  # wall time
+    assert isfile(join(test_home, 'ran'))
+    assert results['startuptime'] == {'median': 0.0125, 'p90': 0.0125,
+                                      'max': 0.0125}
+    assert 0 < results['python']['median'] <= results['python']['p90'] \
+        <= results['python']['max']
+
+    assert dotfiles.percentile([4, 1, 3, 2], 50) == 2.5
+    assert dotfiles.percentile([1, 2, 3, 4, 5], 90) == pytest.approx(4.6)
+    with pytest.raises(ValueError):
+        dotfiles.percentile([], 50)
+    with pytest.raises(SystemExit):
+        dotfiles.get_options(['--bench', '--bench-runs', '0'])
+    if dotfiles.TimeoutExpired is not None:
+        with pytest.raises(OSError):
+            dotfiles.startup_time(
+                [sys.executable, '-c', 'import time; time.sleep(10)'],
+                timeout=0.5)
+
+    baseline_file = join(test_home, '.bench.json')
+    assert dotfiles.bench_baseline('a', baseline_file) is None
+    dotfiles.save_bench_results(results, 'a', baseline_file)
+    dotfiles.save_bench_results(results, 'a', baseline_file)
+    assert dotfiles.bench_baseline('a', baseline_file) is None
+    slower = {'startuptime': {'median': 0.3, 'p90': 0.3, 'max': 0.3}}
+    baseline = dotfiles.bench_baseline('b', baseline_file)
+    assert baseline['startuptime'] == results['startuptime']
+    assert dotfiles.bench_regressions(slower, baseline) == ['startuptime']
+    assert dotfiles.bench_regressions(results, baseline) == []
+    assert dotfiles.bench_regressions(results, None) == []
+    assert dotfiles.bench_regressions(results, results) == []
+    # results are stored per commit, and the baseline is the most recent
+    # other commit
+    dotfiles.save_bench_results(results, 'b', baseline_file)
+    assert dotfiles.bench_baseline('c', baseline_file) == results
+    assert dotfiles.bench_baseline('b', baseline_file) == results
+    with open(baseline_file) as in_fh:
+        assert [entry['commit'] for entry in json.load(in_fh)] == ['a', 'b']
+
+
+def test_main_bench(tmp_path, monkeypatch):
+    """Test that --bench only stores results without regressions"""
+
+    dotfiles_dir = str(tmp_path / 'DOTFILES')
+    dotfiles.mkdir(dotfiles_dir)
+    home = str(tmp_path / 'HOME')
+    dotfiles.mkdir(home)
+    baseline_file = join(dotfiles_dir, '.bench.json')
+    monkeypatch.setattr(dotfiles, 'DOTFILES', dotfiles_dir)
+    monkeypatch.setattr(dotfiles, 'HOME', home)
+    fast = {'nvim': {'median': 0.1, 'p90': 0.1, 'max': 0.1}}
+    slow = {'nvim': {'median': 0.5, 'p90': 0.5, 'max': 0.5}}
+    dotfiles.save_bench_results(fast, 'a', baseline_file)
+    measured = []
+    monkeypatch.setattr(dotfiles.Deployment, 'bench',
+                        lambda deployment, runs: measured.pop(0))
+
+    def commits():
+        with open(baseline_file) as in_fh:
+            return [entry['commit'] for entry in json.load(in_fh)]
+
+    # DOTFILES is not a git checkout, so the commit is 'unknown'
+    measured.append(slow)
+    with pytest.raises(SystemExit):
+        dotfiles.main(None, ['--bench', '--quiet'])
+    assert commits() == ['a']
+    measured.append(fast)
+    dotfiles.main(None, ['--bench', '--quiet'])
+    assert commits() == ['a', 'unknown']